@@ -0,0 +1,196 @@
+"""
+Offline build steps for the Pf-HaploAtlas data store. Run from the repository root, e.g.
+
+    python app/build_store.py index
+    python app/build_store.py genes
+    python app/build_store.py metadata
+    python app/build_store.py matrix
+    python app/build_store.py precompute
+    python app/build_store.py mutation-index
+
+Each command builds the default release in app/files/releases.json unless another is given, e.g.
+
+    python app/build_store.py --release Pf8 genes
+
+The app keeps working from the original files for anything that has not been built yet. precompute can be
+interrupted and rerun, it only builds the artifacts that are missing or out of date.
+"""
+import argparse, functools, os, sys, time
+import concurrent.futures
+
+from src import data_store, precompute
+
+def _print_progress(done: int, total: int, started: float):
+    elapsed = time.time() - started
+    print(f"  {done}/{total} done ({elapsed:.0f} s elapsed)", flush = True)
+
+def _build_genes(args):
+    """Converts every `<gene>.pkl.xz` file into the columnar store"""
+    filenames = sorted(f for f in os.listdir(args.pkl_path) if f.endswith("pkl.xz"))
+    if not args.overwrite:
+        filenames = [f for f in filenames if not data_store.is_gene_converted(f.split(".")[0], args.store_path)]
+
+    print(f"Converting {len(filenames)} gene summaries into {args.store_path}")
+    started = time.time()
+    for i, filename in enumerate(filenames, start = 1):
+        data_store.convert_gene_summary(filename, args.pkl_path, args.store_path)
+        if i % 250 == 0 or i == len(filenames):
+            _print_progress(i, len(filenames), started)
+
+def _build_metadata(args):
+    """Converts the Pf7 metadata spreadsheet into a typed table"""
+    print(f"Converting {args.metadata_xlsx_path} into {args.metadata_path}")
+    data_store.convert_metadata(args.metadata_xlsx_path, args.metadata_path)
+
+def _build_matrix(args):
+    """Builds the genome-wide sample x gene haplotype matrix"""
+    filenames = sorted(f for f in os.listdir(args.pkl_path) if f.endswith("pkl.xz"))
+
+    print(f"Building the haplotype matrix for {len(filenames)} genes into {args.store_path}")
+    started = time.time()
+    def progress(done):
+        if done % 250 == 0 or done == len(filenames):
+            _print_progress(done, len(filenames), started)
+
+    data_store.build_haplotype_matrix(filenames, args.pkl_path, args.store_path, progress = progress)
+
+def _build_index(args):
+    """Builds the gene index, so that the app doesn't list the gene directory and read the JSON files on startup"""
+    print(f"Building the gene index of {args.pkl_path} into {args.store_path}")
+    data_store.build_gene_index(args.pkl_path, args.store_path, gene_names_path = args.gene_names_path,
+                                job_logs_path = args.job_logs_path, regions_path = args.regions_path)
+
+@functools.lru_cache(maxsize = 1)
+def _load_sample_metadata(metadata_path: str, metadata_xlsx_path: str):
+    """Loaded once per worker process rather than once per gene"""
+    return data_store.load_sample_metadata(metadata_path, metadata_xlsx_path)
+
+def _build_gene_artifacts(filename: str, names: list, args: argparse.Namespace) -> dict:
+    """
+    Runs in a worker process. Builds the named artifacts of one gene, skipping the ones already in the store and up to
+    date (see precompute.artifact_versions) unless --overwrite is set. An artifact that fails doesn't stop the others, the errors are returned by artifact name
+    """
+    gene_id = filename.split(".")[0]
+    if not args.overwrite:
+        names = [name for name in names if not data_store.is_gene_artifact_built(gene_id, name, precompute.artifact_versions[name], args.store_path)]
+    if not names:
+        return {}
+
+    df_haplotypes, codes, dictionary, _ = data_store.load_gene_summary(filename, args.pkl_path, args.store_path)
+    df_join = data_store.join_sample_metadata(codes, dictionary, _load_sample_metadata(args.metadata_path, args.metadata_xlsx_path))
+
+    errors = {}
+    for name in names:
+        try:
+            artifact = precompute.artifact_builders[name](df_join, df_haplotypes)
+            data_store.write_gene_artifact(gene_id, name, artifact, precompute.artifact_versions[name], args.store_path)
+        except Exception as error:
+            errors[name] = f"{type(error).__name__}: {error}"
+    return errors
+
+def _build_precompute(args):
+    """Precomputes the plot artifacts of every gene (see precompute.artifact_builders) across a pool of processes"""
+    filenames = sorted(f for f in os.listdir(args.pkl_path) if f.endswith("pkl.xz"))
+
+    print(f"Precomputing {', '.join(args.artifacts)} for {len(filenames)} genes into {args.store_path} with {args.workers} workers")
+    started = time.time()
+    failures = {}
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        futures = {
+            executor.submit(_build_gene_artifacts, filename, args.artifacts, args): filename
+            for filename in filenames
+        }
+        for i, future in enumerate(concurrent.futures.as_completed(futures), start = 1):
+            gene_id = futures[future].split(".")[0]
+            try:
+                errors = future.result()
+            except Exception as error:
+                errors = {"*": f"{type(error).__name__}: {error}"}
+            if errors:
+                failures[gene_id] = errors
+            if i % 250 == 0 or i == len(filenames):
+                _print_progress(i, len(filenames), started)
+
+    if failures:
+        print(f"{len(failures)} genes failed, rerun to retry them:")
+        for gene_id, errors in sorted(failures.items()):
+            for name, error in errors.items():
+                print(f"  {gene_id} {name}: {error}")
+        sys.exit(1)
+
+def _compute_gene_mutation_counts(filename: str, args: argparse.Namespace):
+    """Runs in a worker process"""
+    df_haplotypes = data_store.load_gene_summary(filename, args.pkl_path, args.store_path)[0]
+    return data_store.mutation_counts_table(filename.split(".")[0], precompute.compute_mutation_counts(df_haplotypes))
+
+def _build_mutation_index(args):
+    """Gathers the mutations of every gene, with their sample counts per population, into one table"""
+    filenames = sorted(f for f in os.listdir(args.pkl_path) if f.endswith("pkl.xz"))
+
+    print(f"Building the mutation index of {len(filenames)} genes into {args.store_path} with {args.workers} workers")
+    started = time.time()
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        gene_tables = []
+        for i, table in enumerate(executor.map(_compute_gene_mutation_counts, filenames, [args] * len(filenames), chunksize = 16), start = 1):
+            gene_tables.append(table)
+            if i % 250 == 0 or i == len(filenames):
+                _print_progress(i, len(filenames), started)
+
+    data_store.write_mutation_index(gene_tables, args.store_path)
+    print(f"  {sum(len(table) for table in gene_tables)} mutations written")
+
+def main():
+    releases = data_store.load_releases()
+    parser = argparse.ArgumentParser(description = "Builds the Pf-HaploAtlas data store")
+    parser.add_argument("--release", choices = list(releases), default = next(iter(releases)),
+                        help = "release from app/files/releases.json to build, the paths below default to its files")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    genes_parser = subparsers.add_parser("genes", help = "convert the per-gene lzma-pickle files into the columnar store")
+    genes_parser.add_argument("--pkl-path", help = "defaults to the release's pkl_path")
+    genes_parser.add_argument("--store-path", help = "defaults to the release's store_path")
+    genes_parser.add_argument("--overwrite", action = "store_true", help = "convert genes that are already in the store")
+    genes_parser.set_defaults(func = _build_genes)
+
+    metadata_parser = subparsers.add_parser("metadata", help = "convert the release's metadata spreadsheet into a typed table")
+    metadata_parser.add_argument("--metadata-xlsx-path", help = "defaults to the release's metadata_xlsx_path")
+    metadata_parser.add_argument("--metadata-path", help = "defaults to the release's metadata_path")
+    metadata_parser.set_defaults(func = _build_metadata)
+
+    matrix_parser = subparsers.add_parser("matrix", help = "build the genome-wide sample x gene haplotype matrix")
+    matrix_parser.add_argument("--pkl-path", help = "defaults to the release's pkl_path")
+    matrix_parser.add_argument("--store-path", help = "defaults to the release's store_path")
+    matrix_parser.set_defaults(func = _build_matrix)
+
+    index_parser = subparsers.add_parser("index", help = "build the gene index: gene names, files, chromosomes and job log statistics")
+    index_parser.add_argument("--pkl-path", help = "defaults to the release's pkl_path")
+    index_parser.add_argument("--store-path", help = "defaults to the release's store_path")
+    index_parser.add_argument("--gene-names-path", help = "defaults to the release's gene_names_path")
+    index_parser.add_argument("--job-logs-path", help = "defaults to the release's job_logs_path")
+    index_parser.add_argument("--regions-path", default = data_store.regions_path)
+    index_parser.set_defaults(func = _build_index)
+
+    precompute_parser = subparsers.add_parser("precompute", help = "precompute the per-gene artifacts the plots are sliced from")
+    precompute_parser.add_argument("--pkl-path", help = "defaults to the release's pkl_path")
+    precompute_parser.add_argument("--store-path", help = "defaults to the release's store_path")
+    precompute_parser.add_argument("--artifacts", nargs = "+", choices = list(precompute.artifact_builders), default = list(precompute.artifact_builders))
+    precompute_parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "number of worker processes")
+    precompute_parser.add_argument("--overwrite", action = "store_true", help = "rebuild artifacts that are already in the store")
+    precompute_parser.set_defaults(func = _build_precompute)
+
+    mutation_index_parser = subparsers.add_parser("mutation-index", help = "build the cross-gene index of mutations and their sample counts per population")
+    mutation_index_parser.add_argument("--pkl-path", help = "defaults to the release's pkl_path")
+    mutation_index_parser.add_argument("--store-path", help = "defaults to the release's store_path")
+    mutation_index_parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "number of worker processes")
+    mutation_index_parser.set_defaults(func = _build_mutation_index)
+
+    args = parser.parse_args()
+    # Paths that weren't given come from the release, including the ones a command has no option for, as precompute
+    # also needs the release's sample metadata
+    for path in data_store.release_paths:
+        if getattr(args, path, None) is None:
+            setattr(args, path, releases[args.release][path])
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
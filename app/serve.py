@@ -0,0 +1,23 @@
+"""
+Starts the app like `streamlit run app/main.py`, but warms up its caches (see caches.warm_up_caches) while the server
+starts rather than when the first user arrives. Run from the repository root, passing any option of
+`streamlit run`, e.g.
+
+    HAPLOATLAS_METRICS_PORT=9100 python app/serve.py --server.port 8501
+
+With HAPLOATLAS_METRICS_PORT set, http://localhost:9100/ready answers 503 while the caches warm up and 200 once they
+are warm, for orchestrators to poll before routing users to the process
+"""
+import os, sys
+from streamlit.web import cli
+
+# The app's scripts import the same modules, so they find the caches filled here
+from src import caches
+
+def main():
+    caches.start_metrics_server()
+    caches.start_warm_up()
+    cli.main(["run", os.path.join(os.path.dirname(__file__), "main.py"), *sys.argv[1:]], prog_name = "streamlit")
+
+if __name__ == "__main__":
+    main()
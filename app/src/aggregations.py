@@ -0,0 +1,41 @@
+"""
+Vectorised group-by helpers used by precompute, to build the abacus and world map aggregates, and by the multi-gene
+plot. Samples are grouped once into integer codes and everything else is counted with np.bincount, rather than
+calling a Python function per group
+"""
+import numpy as np
+import pandas as pd
+
+def group_codes(df: pd.DataFrame, keys: list):
+    """
+    Assigns each row the index of its group, with groups sorted by keys and only observed combinations kept.
+    Rows with a missing key get -1, mirroring groupby's default of dropping them. Returns the codes along with
+    a dataframe of the group keys
+    """
+    # Plain strings rather than categoricals, so that groups come back sorted and only the observed ones are kept
+    df_keys = pd.DataFrame({key: df[key].astype(object).values for key in keys})
+    codes = df_keys.groupby(keys, sort = True).ngroup().fillna(-1).values.astype(int)
+    groups = df_keys.dropna().drop_duplicates().sort_values(keys).reset_index(drop = True)
+    return codes, groups
+
+def count_by_group(codes: np.ndarray, n_groups: int, mask = None) -> np.ndarray:
+    """Number of rows in each group, optionally only counting rows where mask is True"""
+    selected = codes >= 0 if mask is None else ( codes >= 0 ) & mask
+    return np.bincount(codes[selected], minlength = n_groups)
+
+def joint_haplotype_counts(df: pd.DataFrame, loci: list, key: str) -> pd.DataFrame:
+    """
+    Counts the samples of every multi-locus haplotype, the combination of their haplotypes at the loci columns, per
+    value of key. Returns one row per multi-locus haplotype with its loci, a count column per key value and Total,
+    sorted by decreasing Total
+    """
+    haplotype_codes, haplotypes = group_codes(df, loci)
+    key_codes, key_values = group_codes(df, [key])
+
+    known = ( haplotype_codes >= 0 ) & ( key_codes >= 0 )
+    cells = haplotype_codes[known] * len(key_values) + key_codes[known]
+    counts = np.bincount(cells, minlength = len(haplotypes) * len(key_values)).reshape(len(haplotypes), len(key_values))
+
+    haplotypes[list(key_values[key])] = counts
+    haplotypes['Total'] = counts.sum(axis = 1)
+    return haplotypes.sort_values('Total', ascending = False, kind = 'stable').reset_index(drop = True)
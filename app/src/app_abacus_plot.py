@@ -1,11 +1,11 @@
 import streamlit as st
-import collections
-import pandas as pd
 import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from src.utils import cache_load_population_colours, generate_download_buttons, _cache_load_utility_mappers, _st_justify_markdown_html
+from src.utils import cache_load_population_colours, cache_load_gene_artifact, cache_build_figure, generate_download_buttons, _cache_load_utility_mappers, _st_justify_markdown_html
+from src.precompute import slice_abacus_cube
 
 def _plotly_arrow(x0, x1, y):
     """One time function used to generate the arrow in the legend of the abacus plot"""
@@ -16,19 +16,6 @@ def _plotly_arrow(x0, x1, y):
 
     return a
 
-def _locations_agg(x, ns_changes):
-    """Aggregation function used to reformat dataframe in preparation for abacus plot"""
-    names = collections.OrderedDict()
-    names['n'] = np.count_nonzero(x['ns_changes_homozygous'])
-    if names['n'] == 0:
-        names[f'{ns_changes} frequency'] = np.nan
-    else:
-        names[f'{ns_changes} frequency'] = np.count_nonzero(
-            ( x['ns_changes'] == ns_changes)
-        ) / names['n']
-
-    return pd.Series(names)
-
 def _partial_frequency_marker_colour(freq: float) -> str:
     """
     Convenience function which takes haplotype frequency and returns an rgba string for the grey colour used to
@@ -40,52 +27,15 @@ def _partial_frequency_marker_colour(freq: float) -> str:
     return marker_colour
 
 
-def generate_abacus_plot(ns_changes, df_join, min_samples, df_haplotypes_set, gene_id_selected):
-    """Main function called in main.py to generate and present the abacus plot"""
-    
-    population_colours = cache_load_population_colours()
-    utility_mappers = _cache_load_utility_mappers()
+def _build_abacus_figure(ns_changes, min_samples, populations, gene_id_selected, gene_name_selected):
+    """Builds the abacus plot figure"""
 
-    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
+    population_colours = cache_load_population_colours()
 
-    # Filter QC fail and missing samples  
-    df_samples_with_ns_changes = df_join[df_join['Exclusion reason'] == 'Analysis_set'].copy()
-    
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Democratic Republic of the Congo', ['Country']] = 'DRC'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes.ns_changes == "", "ns_changes"] = "3D7 REF"
-
-    df_samples_with_ns_changes.loc[:,'ns_changes_homozygous'] = ( df_samples_with_ns_changes['ns_changes'] == df_samples_with_ns_changes['ns_changes'].str.upper() )
-
-    aggregated_locations = df_samples_with_ns_changes.groupby(['Population', 'Country', 'Admin level 1']).apply(lambda x: len(x) >= min_samples)
-    locations = aggregated_locations.index[aggregated_locations.values].values
-
-    df_frequencies = (
-        df_samples_with_ns_changes
-        .groupby(['Population', 'Year', 'Country', 'Admin level 1'])
-        .apply(lambda x: _locations_agg(x, ns_changes))
-        .reset_index()
-        .set_index(['Population', 'Country', 'Admin level 1'])
-        .loc[locations]
-        .reset_index()
-    )
-    df_frequencies = df_frequencies.loc[df_frequencies['n'] >= min_samples]
+    # Per location and year haplotype counts are fixed for a gene, so only the slice for this haplotype is needed here
+    df_frequencies = slice_abacus_cube(cache_load_gene_artifact(gene_id_selected, "abacus"), ns_changes, min_samples)
     df_frequencies['Label'] = df_frequencies['Country'] + ', ' + df_frequencies['Admin level 1']
 
-    populations = [col for col in df_haplotypes_set.columns if col not in ["number_of_mutations", "ns_changes", "Total", "ns_changes_list", "sample_names", "cum_proportion"]]
-    label = {p: df_frequencies.loc[df_frequencies['Population'] == p, 'Admin level 1'].nunique() for p in populations}
-
-    # ============================================================================================================================================================
-    # ============================================================================================================================================================
-
-    st.divider()
-
-    st.subheader(f'2. Abacus plot: {ns_changes}')
-    _st_justify_markdown_html("""
-The Abacus plot shows how the haplotype frequency of your selected haplotype changes across locations and time (in years). The colour intensity of each “bead” on the Abacus plot corresponds to its observed frequency in each year and in each location. Haplotypes at fixation are marked with “100” to highlight 100% frequency, whilst “beads” with 0% haplotype frequency are crossed out. Hover your mouse over the data to see details. 
-
-Click and drag to zoom to focus on certain locations. Double-click to reset. 
-""")
-
     fig = make_subplots(rows = 2, cols = 4,
                         vertical_spacing = 0,
                         horizontal_spacing = 0.05,
@@ -101,14 +51,9 @@ Click and drag to zoom to focus on certain locations. Double-click to reset.
 
     xlims = [(1982, 1986), (1994,1998), (2000,2019)]
 
-    labels_list = []
-    population_colours_list = []
-
-
     def _abacus_scatter(**kwargs):
         """Convenience function for creating scatter points on the abacus plot"""
         return go.Scatter(
-            customdata = [[row.n, int(row.n * row[ns_changes + ' frequency']), np.round(row[ns_changes + ' frequency'] * 100, 1)]],
             showlegend = False,
             **kwargs
         )
@@ -119,7 +64,8 @@ Click and drag to zoom to focus on certain locations. Double-click to reset.
                            size=13,
                            symbol="circle-x",
                            line=dict(color='gray',
-                                     width=1))
+                                     width=1)),
+            "mode": "markers"
         },
         "full_frequency": {
             "marker": dict(color="black",
@@ -132,53 +78,59 @@ Click and drag to zoom to focus on certain locations. Double-click to reset.
         },
     }
     
-    hovertemplate = '<b>%{y} in %{x}</b><br>Samples with selected haplotype: %{customdata[1]} (%{customdata[2]}%)<br>Number of samples: %{customdata[0]}<extra></extra>',
+    hovertemplate = '<b>%{y} in %{x}</b><br>Samples with selected haplotype: %{customdata[1]} (%{customdata[2]}%)<br>Number of samples: %{customdata[0]}<extra></extra>'
+
+    # Locations are listed by population (in reverse, as the y axis runs bottom to top), then by country in order of appearance
+    population_rank = {pop: rank for rank, pop in enumerate(reversed(populations))}
+    df_frequencies = df_frequencies.loc[df_frequencies['Population'].isin(population_rank)]
+    df_frequencies = df_frequencies.assign(
+        population_rank = df_frequencies['Population'].map(population_rank),
+        country_rank    = df_frequencies.groupby('Population')['Country'].transform(lambda country: pd.factorize(country)[0])
+    ).sort_values(['population_rank', 'country_rank'], kind = 'stable')
+
+    df_labels = df_frequencies.drop_duplicates('Label')
+    labels_list = df_labels['Label'].tolist()
+    population_colours_list = [population_colours[pop] for pop in df_labels['Population']]
+
+    # One trace per bead style and year panel rather than one per bead, with the per-bead values held in arrays
+    frequency = df_frequencies[ns_changes + ' frequency'].values
+    customdata = np.column_stack([df_frequencies['n'].values, ( df_frequencies['n'].values * frequency ).astype(int), np.round(frequency * 100, 1)])
+    bead_styles = {
+        "zero_frequency":    frequency == 0,
+        "full_frequency":    frequency == 1,
+        "partial_frequency": ( frequency != 0 ) & ( frequency != 1 ),
+    }
 
     for i in [2, 3, 4]:
         fig.update_xaxes(range=xlims[i-2], row=2, col=i, showgrid=False)
 
-        for pop in reversed(populations):
-
-            country = df_frequencies.loc[df_frequencies['Population'] == pop, 'Country']
-            _, idx = np.unique(country, return_index=True)
-            country = country.reset_index(drop=True)
-
-            for c in country[np.sort(idx)]:
-
-                data = df_frequencies[(df_frequencies['Population'] == pop) & (df_frequencies['Country'] == c)]
-
-                for index, row in data.iterrows():
-
-                    if row.Label not in labels_list:
-                        labels_list.append(row.Label)
-                        population_colours_list.append(population_colours[row.Population])
-
-                    if row[ns_changes + ' frequency'] == 0:
-                        fig.add_traces(
-                            _abacus_scatter(x = [row.Year], y = [row.Label],
-                                            hovertemplate = hovertemplate,
-                                            **scatter_config["zero_frequency"]
-                                           ), rows = 2, cols = i)
-
-                    elif row[ns_changes + ' frequency'] == 1:
-                        fig.add_traces(
-                            _abacus_scatter(x = [row.Year], y = [row.Label],
-                                            hovertemplate = hovertemplate,
-                                            **scatter_config["full_frequency"]
-                                           ), rows = 2, cols = i)
-
-                    else:
-                        fig.add_traces(
-                            _abacus_scatter(x = [row.Year], y = [row.Label],
-                                            hovertemplate = hovertemplate,
-                                            marker=dict(color = _partial_frequency_marker_colour(row[ns_changes + ' frequency']),
-                                                        size = 16, symbol = "circle",
-                                                        line=dict(
-                                                            color='black',
-                                                            width=1.5)
-                                                        )
-                                           ), rows = 2, cols = i)
-                        
+        for style, beads in bead_styles.items():
+            if not beads.any():
+                continue
+
+            if style == "partial_frequency":
+                config = {
+                    "mode": "markers",
+                    "marker": dict(color = [_partial_frequency_marker_colour(freq) for freq in frequency[beads]],
+                                   size = 16, symbol = "circle",
+                                   line=dict(
+                                       color='black',
+                                       width=1.5)
+                                   )
+                }
+            else:
+                config = scatter_config[style]
+
+            fig.add_traces(
+                _abacus_scatter(x = df_frequencies['Year'].values[beads], y = df_frequencies['Label'].values[beads],
+                                customdata = customdata[beads],
+                                hovertemplate = hovertemplate,
+                                **config
+                               ), rows = 2, cols = i)
+
+    # The bead traces no longer run in location order, so the order of the locations is set explicitly
+    fig.update_yaxes(categoryorder = "array", categoryarray = labels_list, row = 2)
+
     fig.update_xaxes(title_text="Year", row=2, col=3)
     fig.update_yaxes(title_text="Location", row=2, col=1)
 
@@ -206,11 +158,11 @@ Click and drag to zoom to focus on certain locations. Double-click to reset.
         go.Scatter(x = [0.4, 0.6], y = [0.6, 0.6], hoverinfo = "none", showlegend = False, mode = "text", text = ["0%", "100%"]),
         go.Scatter(x = [0.5], y = [0.9], hoverinfo = "none", showlegend = False, mode = "text", text = ["Haplotype Frequency"])] +
 
-        [_abacus_scatter(x = [pos], y = [legend_y], hoverinfo = "none",
-                         marker=dict(color = _partial_frequency_marker_colour(freq),
+        [_abacus_scatter(x = partial_frequency_positions, y = [legend_y] * len(partial_frequency_positions), hoverinfo = "none", mode = "markers",
+                         marker=dict(color = [_partial_frequency_marker_colour(freq) for freq in partial_frequency_frequencies],
                                      size = 16, symbol = "circle",
                                      line=dict(color='black', width=1.5))
-                        ) for pos, freq in zip(partial_frequency_positions, partial_frequency_frequencies)],
+                        )],
         
         rows = 1, cols = 1)
 
@@ -241,6 +193,33 @@ Click and drag to zoom to focus on certain locations. Double-click to reset.
         margin=dict(t=50, b=55, l=0, r=0)
     )
 
+    return fig
+
+def generate_abacus_plot(ns_changes, min_samples, df_haplotypes_set, gene_id_selected):
+    """Main function called in main.py to generate and present the abacus plot"""
+    
+    utility_mappers = _cache_load_utility_mappers()
+
+    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
+    populations = [col for col in df_haplotypes_set.columns if col not in ["number_of_mutations", "ns_changes", "Total", "ns_changes_list", "sample_names", "cum_proportion"]]
+
+    # ============================================================================================================================================================
+    # ============================================================================================================================================================
+
+    st.divider()
+
+    st.subheader(f'2. Abacus plot: {ns_changes}')
+    _st_justify_markdown_html("""
+The Abacus plot shows how the haplotype frequency of your selected haplotype changes across locations and time (in years). The colour intensity of each “bead” on the Abacus plot corresponds to its observed frequency in each year and in each location. Haplotypes at fixation are marked with “100” to highlight 100% frequency, whilst “beads” with 0% haplotype frequency are crossed out. Hover your mouse over the data to see details. 
+
+Click and drag to zoom to focus on certain locations. Double-click to reset. 
+""")
+
+    # The figure only depends on these settings, so reruns that change anything else reuse it
+    figure_key = (ns_changes, min_samples)
+    fig = cache_build_figure(gene_id_selected, 2, figure_key,
+                             lambda: _build_abacus_figure(ns_changes, min_samples, populations, gene_id_selected, gene_name_selected))
+
     st.plotly_chart(fig, config = {"displayModeBar": False})
 
-    generate_download_buttons(fig, gene_id_selected, 1300, 800, plot_number = 2)
+    generate_download_buttons(fig, gene_id_selected, 1300, 800, plot_number = 2, export_key = figure_key)
@@ -1,8 +1,9 @@
 import streamlit as st
 import pandas as pd
-import json
 
-from src.utils import _cache_load_utility_mappers
+from src import data_store
+from src.utils import _cache_load_utility_mappers, cache_load_gene_artifact, cache_load_gene_job_logs
+from src.precompute import count_haplotypes_shown
 
 def process_configs_menu(gene_id_selected, df_haplotypes, df_join):
     """Main function called in main.py to handle user config settings in the expander"""
@@ -78,7 +79,7 @@ def _config_download_data_section(gene_id_selected, df_haplotypes, df_join):
                        use_container_width = True)
     
     st.download_button("Download sample-level summary",
-                       _encode_df(df_join.drop(columns = ["index"])),
+                       _encode_df(df_join.drop(columns = ["index", *data_store.country_columns])),
                        file_name = f'pf-haploatlas-{gene_id_selected}_sample_summary.csv',
                        help = '''Explanation of columns: "Exclusion reason" describes the reason for a sample's removal from analysis;	"ns_changes" describes the amino acid changes of the sample for the gene selected; "Sample" is the sample name; "Study" is the clinical study of origin; "Country" of sample collection; "Admin level"	is the location of sample collection; "latitude", "longitude, "Year" of sample collection; "ENA" is the ID in the European Nucleotide Archive; "All samples same case" is reformatted sample name, "Population" refers to geographic distribution (see sidebar for details); "% callable" of SNPs, "QC pass" is whether the sample passed quality control for Pf7, "Sample type" for sequencing, "Sample was in Pf6" is whether the sample was in the previous Pf6 data resource''',
                        use_container_width = True)
@@ -93,20 +94,18 @@ def _config_plot_settings_section():
 def _process_gene_facts(min_samples,
                         df_haplotypes,
                         df_join,
-                        gene_id_selected,
-                        job_logs_file="app/files/job_logs.json"):
+                        gene_id_selected):
 
-    with open(job_logs_file, "r") as file:
-        job_logs = json.load(file)
-    
-    gene_info = job_logs[gene_id_selected]
+    gene_info = cache_load_gene_job_logs(gene_id_selected)
 
     # Extract statistics
     pf7_qc_pass            = len(df_join.loc[df_join['QC pass']==True])
     missing_genotype_calls = gene_info.get('c_missing', 'N/A')
     heterozygous_calls     = gene_info.get('c_het_calls', 'N/A')
     stop_codons            = gene_info.get('c_stop_codon', 'N/A')
-    sample_below_threshold = df_haplotypes.loc[df_haplotypes['Total'] < min_samples].Total.sum()
+    haplotype_totals       = cache_load_gene_artifact(gene_id_selected, "totals")
+    haplotypes_shown       = count_haplotypes_shown(haplotype_totals, min_samples)
+    sample_below_threshold = haplotype_totals["cum_totals"][-1] - haplotype_totals["cum_totals"][haplotypes_shown]
     excluded_samples       = int(missing_genotype_calls + heterozygous_calls + stop_codons + sample_below_threshold)
     included_samples       = int(pf7_qc_pass - excluded_samples)
 
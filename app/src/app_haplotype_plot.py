@@ -1,49 +1,38 @@
 import streamlit as st
-import pandas as pd
+import collections
 import numpy as np
+import plotly
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from streamlit_plotly_events2 import plotly_events
 
-from src.utils import cache_load_population_colours, _cache_load_utility_mappers, generate_download_buttons, _st_justify_markdown_html
+from src.utils import cache_load_population_colours, cache_load_gene_artifact, cache_build_figure, _cache_load_utility_mappers, generate_download_buttons, _st_justify_markdown_html
+from src.precompute import count_haplotypes_shown, slice_mutation_index, slice_mutation_index_for_haplotypes
 
-def generate_haplotype_plot(df_haplotypes, gene_id_selected, background_ns_changes, min_samples, sample_count_mode):
-    """Main function called in main.py to generate and present haplotype plot"""
-    
-    population_colours = cache_load_population_colours()
-    utility_mappers = _cache_load_utility_mappers()
+# Genes with more haplotypes than this are shown one page of haplotypes at a time
+haplotypes_per_page = 100
 
-    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
-    
-    st.divider()
-    st.subheader(f'1. Haplotype UpSet plot: {gene_name_selected}')
+def _select_haplotype_page(different_haplotypes):
+    """Lets the user page through the haplotypes when there are too many for one plot, returning the page's (start, stop) positions"""
+    if different_haplotypes <= haplotypes_per_page:
+        return 0, different_haplotypes
 
-    # Inputs for plots
-    total_samples = df_haplotypes['Total'].sum()
-    df_haplotypes['cum_proportion'] = df_haplotypes['Total'].cumsum() / total_samples 
-    df_haplotypes_set = df_haplotypes.loc[df_haplotypes['Total'] >= min_samples] 
-    df_haplotypes_set.loc[df_haplotypes_set['ns_changes'] == '', 'ns_changes'] = '3D7 REF'
-    different_haplotypes= len(df_haplotypes_set)
-    if different_haplotypes == 0:
-        st.warning("No haplotype data found.")
-        st.stop()
-    elif different_haplotypes >100:
-        st.warning(f"{different_haplotypes} different haplotypes found, which is too many to show here. You can download the data or increase the minimum sample size from 'Click to see more about the data'.")
-        st.stop()
-    mutations = pd.Series(np.unique(np.concatenate(df_haplotypes_set['ns_changes_list'].values)))
-    mutations = mutations.loc[mutations != '']
-    mutations_np_ref = mutations.apply(lambda x: x[1:])
-    aa = mutations_np_ref.apply(lambda x: int(x[:-1]))
-    df_mutations_set = pd.DataFrame(
-        {
-            'mutation': mutations.values,
-            'aa': aa.values,
-        }
-    ).sort_values('aa').reset_index(drop=True).reset_index().set_index('mutation')
+    st.info(f"{different_haplotypes} different haplotypes found, which are shown {haplotypes_per_page} at a time from the most to the least common. You can download the data or increase the minimum sample size from 'Click to see more about the data'.")
+    page_start = st.select_slider("Haplotypes shown",
+                                  options = list(range(0, different_haplotypes, haplotypes_per_page)),
+                                  format_func = lambda start: f"{start + 1} - {min(start + haplotypes_per_page, different_haplotypes)}")
+    return page_start, min(page_start + haplotypes_per_page, different_haplotypes)
 
-    # Some arbitrary plot-scaling calculations
-    upset_plot_height = int(1.5 + len(df_mutations_set) / 5)
-    total_plot_height = int((5 + upset_plot_height) * 100)
+def _upset_plot_height(df_mutations_set):
+    """Some arbitrary plot-scaling calculations, in units of 100 px"""
+    return int(1.5 + len(df_mutations_set) / 5)
+
+def _build_haplotype_figure(df_haplotypes_set, df_mutations_set, background_ns_changes, gene_name_selected, sample_count_mode):
+    """Builds the haplotype UpSet plot figure"""
+
+    population_colours = cache_load_population_colours()
+    different_haplotypes = len(df_haplotypes_set)
+    upset_plot_height = _upset_plot_height(df_mutations_set)
 
     # Create the plots
     fig = make_subplots(rows = 3, cols = 1, shared_xaxes = True, row_heights = [2, 3, upset_plot_height], vertical_spacing = 0.05)
@@ -112,7 +101,6 @@ def generate_haplotype_plot(df_haplotypes, gene_id_selected, background_ns_chang
 
     marker_size = 5 + np.sqrt(len(df_haplotypes_set))
 
-    i = 0
     if ( '' not in background_ns_changes ) and background_ns_changes in df_haplotypes_set['ns_changes'].values:
         background_mutation_indices = df_mutations_set.loc[
             df_haplotypes_set.loc[
@@ -124,39 +112,39 @@ def generate_haplotype_plot(df_haplotypes, gene_id_selected, background_ns_chang
     else:
         background_mutation_indices = []
 
-    for ix, row in df_haplotypes_set.iterrows():
-        if row['ns_changes_list'][0] != '':
-            indexes = df_mutations_set.loc[row['ns_changes_list'], 'index'].values
-            fig.add_traces(go.Scatter(
-                x = [i] * len(indexes),
-                y = indexes,
-                showlegend=False,
-                hoverinfo = 'none',
-                mode = "lines"),
-                           rows = 3, cols = 1)
-
-            background_mutations = np.intersect1d(indexes, background_mutation_indices)
-            other_mutations = np.setdiff1d(indexes, background_mutation_indices)
-
-            fig.add_traces(go.Scatter(
-                x = [i] * len(background_mutations),
-                y = background_mutations,
-                showlegend=False,
-                hovertemplate='%{y}<extra></extra>',
-                mode='lines+markers',
-                marker=dict(size=marker_size)
-            ),
-                           rows = 3, cols = 1)
-            fig.add_traces(go.Scatter(
-                x = [i] * len(other_mutations),
-                y = other_mutations,
-                showlegend=False,
-                mode='lines+markers',
-                hovertemplate='%{y}<extra></extra>',
-                marker=dict(size=marker_size)
-            ),
-                           rows = 3, cols = 1)
-        i = i + 1
+    # Each haplotype's mutations are drawn as a stick, with the background mutations and the other mutations on top of
+    # it, and each of the three coloured by cycling through the default colours. Rather than three traces per haplotype,
+    # sticks sharing a colour are batched into one trace, separated by None
+    colorway = fig.layout.template.layout.colorway or plotly.colors.qualitative.D3
+    trace_index = len(fig.data)
+    sticks = {role: collections.defaultdict(lambda: ([], [])) for role in ["all", "background", "other"]}
+
+    for i, ns_changes_list in enumerate(df_haplotypes_set['ns_changes_list'].values):
+        if ns_changes_list[0] == '':
+            continue
+
+        indexes = df_mutations_set.loc[ns_changes_list, 'index'].values
+        mutations = {
+            "all":        indexes,
+            "background": np.intersect1d(indexes, background_mutation_indices),
+            "other":      np.setdiff1d(indexes, background_mutation_indices),
+        }
+        for role, y in mutations.items():
+            x_batch, y_batch = sticks[role][colorway[trace_index % len(colorway)]]
+            if len(y) > 0:
+                x_batch.extend([i] * len(y) + [None])
+                y_batch.extend(list(y) + [None])
+            trace_index += 1
+
+    for role, batches in sticks.items():
+        for colour, (x, y) in batches.items():
+            if not x:
+                continue
+            if role == "all":
+                scatter_config = dict(hoverinfo = 'none', mode = "lines", line = dict(color = colour))
+            else:
+                scatter_config = dict(hovertemplate = '%{y}<extra></extra>', mode = 'lines+markers', marker = dict(size = marker_size, color = colour), line = dict(color = colour))
+            fig.add_traces(go.Scatter(x = x, y = y, showlegend = False, connectgaps = False, **scatter_config), rows = 3, cols = 1)
     
     fig.update_xaxes(row = 1, col = 1, fixedrange = True)
     fig.update_xaxes(row = 2, col = 1, fixedrange = True)
@@ -186,6 +174,44 @@ def generate_haplotype_plot(df_haplotypes, gene_id_selected, background_ns_chang
         margin=dict(t=40, b=70, l=80, r=5)
     )
 
+    return fig
+
+def generate_haplotype_plot(df_haplotypes, gene_id_selected, background_ns_changes, min_samples, sample_count_mode):
+    """Main function called in main.py to generate and present haplotype plot"""
+    
+    utility_mappers = _cache_load_utility_mappers()
+
+    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
+    
+    st.divider()
+    st.subheader(f'1. Haplotype UpSet plot: {gene_name_selected}')
+
+    # Inputs for plots. Haplotypes are sorted by decreasing Total, so the ones shown are a prefix of df_haplotypes
+    haplotype_totals = cache_load_gene_artifact(gene_id_selected, "totals")
+    different_haplotypes = count_haplotypes_shown(haplotype_totals, min_samples)
+    if different_haplotypes == 0:
+        st.warning("No haplotype data found.")
+        st.stop()
+
+    # Only the page of haplotypes shown is sliced out of df_haplotypes
+    page_start, page_stop = _select_haplotype_page(different_haplotypes)
+    df_haplotypes_set = df_haplotypes.iloc[page_start:page_stop].copy()
+    df_haplotypes_set['cum_proportion'] = haplotype_totals["cum_totals"][page_start + 1:page_stop + 1] / haplotype_totals["cum_totals"][-1]
+    df_haplotypes_set.loc[df_haplotypes_set['ns_changes'] == '', 'ns_changes'] = '3D7 REF'
+
+    # The mutations of the haplotypes shown, from the gene's precomputed mutation index
+    mutation_index = cache_load_gene_artifact(gene_id_selected, "mutations")
+    if page_stop - page_start == different_haplotypes:
+        df_mutations_set = slice_mutation_index(mutation_index, min_samples)
+    else:
+        df_mutations_set = slice_mutation_index_for_haplotypes(mutation_index, df_haplotypes_set['ns_changes_list'].values)
+    total_plot_height = int((5 + _upset_plot_height(df_mutations_set)) * 100)
+
+    # The figure only depends on these settings, so reruns that change anything else reuse it
+    figure_key = (min_samples, sample_count_mode, page_start)
+    fig = cache_build_figure(gene_id_selected, 1, figure_key,
+                             lambda: _build_haplotype_figure(df_haplotypes_set, df_mutations_set, background_ns_changes, gene_name_selected, sample_count_mode))
+
     # ============================================================================================================================================================
     # ============================================================================================================================================================
 
@@ -203,7 +229,7 @@ You can <b><u>investigate a specific haplotype by clicking on any of the data el
 
     selection_dict = plotly_events(fig, override_height = total_plot_height, config = {"displayModeBar": False})
 
-    generate_download_buttons(fig, gene_id_selected, total_plot_height, 800, plot_number = 1)
+    generate_download_buttons(fig, gene_id_selected, total_plot_height, 800, plot_number = 1, export_key = figure_key)
 
     if selection_dict == []:
         st.stop()
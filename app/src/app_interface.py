@@ -1,7 +1,6 @@
 import streamlit as st
-from base64 import b64encode
 
-from src.utils import _cache_load_utility_mappers, _cache_load_pf7_metadata, _st_justify_markdown_html, _show_cookie_banner_upon_visit, present_changelog
+from src.utils import _cache_load_utility_mappers, _cache_load_gene_search, _cache_load_release_mappers, _cache_load_releases, _cache_load_release_metadata, selected_release, _cache_start_metrics_server, _cache_start_warm_up, _st_justify_markdown_html, _show_cookie_banner_upon_visit, present_changelog, cancel_gene_prefetch, priority_gene_ids
 from streamlit_gtag import st_gtag
 
 def set_up_interface():
@@ -45,7 +44,11 @@ def set_up_interface():
         unsafe_allow_html=True
     )
 
-    _cache_load_pf7_metadata() # running it here to prevent it from running when new gene selected
+    _release_selector()
+
+    _cache_load_release_metadata(selected_release()) # running it here to prevent it from running when new gene selected
+    _cache_start_metrics_server()
+    _cache_start_warm_up()
     
     st.divider()
     
@@ -60,7 +63,7 @@ The Pf-HaploAtlas journal manuscript can be found in the sidebar. Pf-HaploAtlas
 
 #### Search for a gene below to get started.
 
-If you're new here, try clicking below and typing "AAT1"! Alternatively, choose from the key drug resistance genes we've placed at the top of the list (DHFR-TS, MDR1, CRT, PPPK-DHPS, Kelch13).
+If you're new here, try typing "AAT1" in the search box below! Alternatively, choose from the key drug resistance genes listed below it before you search (DHFR-TS, MDR1, CRT, PPPK-DHPS, Kelch13).
 
 """, location = placeholder)
 
@@ -70,6 +73,31 @@ If you're new here, try clicking below and typing "AAT1"! Alternatively, choose
     
     return placeholder
 
+# Views of the app, by the key main.py dispatches on
+modes = {
+    "gene":      "Single gene",
+    "multigene": "Compare a panel of genes",
+    "mutations": "Search mutations",
+}
+
+def mode_selector():
+    """
+    Main function called in main.py to switch between a single gene, the comparison of a panel of genes and the
+    search of mutations across every gene
+    """
+    return st.radio("View", list(modes), format_func = modes.get, key = "mode", horizontal = True, label_visibility = "collapsed",
+                    help = "Compare a panel of genes shows the combined (multi-locus) haplotypes of several genes, e.g. the key drug resistance genes. Search mutations finds the mutations of any gene above a frequency in a population")
+
+# Number of genes matching the search offered in the gene selector
+gene_search_results = 20
+
+def _on_gene_search():
+    """Opens the gene straight away when the search is exactly a gene ID or gene name"""
+    gene_id = _cache_load_gene_search(selected_release()).lookup(st.session_state["gene_search"])
+    if gene_id is not None:
+        st.session_state["gene_id"] = _cache_load_utility_mappers()["gene_ids_to_gene_names"][gene_id]
+        cancel_gene_prefetch()
+
 def file_selector(placeholder):
     """Main function called in main.py to allow for user's gene selection and handle the app's URL"""
 
@@ -84,18 +112,26 @@ def file_selector(placeholder):
 
     if gene_id_extracted and "gene_id" not in st.session_state:
         st.session_state["gene_id"] = gene_id_extracted
-    
-    priority_gene_ids = [
-        "PF3D7_0417200", "PF3D7_0523000", "PF3D7_0709000", "PF3D7_0810800", "PF3D7_1343700"
-    ]
-    priority_gene_names = [utility_mappers["gene_ids_to_gene_names"][gene_id] for gene_id in priority_gene_ids]
-    
-    gene_id_selected = st.selectbox(" ",
-                                    ["--"] + priority_gene_names + ["--"] + [utility_mappers["gene_ids_to_gene_names"][gene_id]
-                                              for gene_id in utility_mappers["gene_ids"] 
-                                              if gene_id in utility_mappers["gene_ids_to_gene_names"].keys()],
-                                    key="gene_id", label_visibility='collapsed'
-                                   )
+
+    search = st.text_input("Search for a gene", key = "gene_search", on_change = _on_gene_search,
+                           placeholder = "Search by gene ID or gene name, e.g. AAT1 or PF3D7_1343700", label_visibility = 'collapsed')
+
+    # Only the best matches of the search are sent to the browser rather than every gene, the key drug resistance
+    # genes being listed until something is searched
+    if search.strip():
+        gene_ids_shown = _cache_load_gene_search(selected_release()).search(search, gene_search_results)
+        if not gene_ids_shown:
+            st.caption(f'No gene matches "{search}".')
+    else:
+        gene_ids_shown = [gene_id for gene_id in priority_gene_ids if gene_id in utility_mappers["gene_ids_to_gene_names"]]
+    gene_names_shown = [utility_mappers["gene_ids_to_gene_names"][gene_id] for gene_id in gene_ids_shown]
+
+    # The gene being viewed stays an option whatever is searched, otherwise it would be deselected
+    if st.session_state.get("gene_id", "--") not in ["--"] + gene_names_shown:
+        gene_names_shown.insert(0, st.session_state["gene_id"])
+
+    gene_id_selected = st.selectbox(" ", ["--"] + gene_names_shown, key = "gene_id", label_visibility = 'collapsed',
+                                    on_change = cancel_gene_prefetch)
     
     if "--" in gene_id_selected:
         # placeholder.markdown("### Search for a gene below to get started.")
@@ -116,14 +152,42 @@ def file_selector(placeholder):
     placeholder.empty()
     return filename, gene_id_selected
 
-def _show_images_with_urls(filepaths, urls, widths, heights):
+def _release_selector():
+    """Lets the user switch between data releases when the app serves more than one, keeping the choice in the URL"""
+
+    releases = _cache_load_releases()
+    if len(releases) < 2:
+        return
+
+    if "release" not in st.session_state and st.query_params.get("release") in releases:
+        st.session_state["release"] = st.query_params["release"]
+
+    release_selected = st.selectbox("Data release", list(releases),
+                                    format_func = lambda release_id: releases[release_id]["name"],
+                                    key = "release", on_change = _on_release_change)
+
+    if release_selected != next(iter(releases)):
+        st.query_params["release"] = release_selected
+    elif "release" in st.query_params:
+        del st.query_params["release"]
+
+def _on_release_change():
+    """Clears the gene selection if the gene isn't part of the newly selected release"""
+    gene_names = _cache_load_release_mappers(st.session_state["release"])["gene_names_to_gene_ids"]
+    if st.session_state.get("gene_id") not in gene_names:
+        st.session_state["gene_id"] = "--"
+
+def _show_images_with_urls(filenames, urls, widths, heights):
+    """
+    Shows images from app/static, which Streamlit serves as static files (enableStaticServing in .streamlit/config.toml),
+    so the browser downloads and caches them once rather than receiving them inline on every rerun
+    """
     images_html = "<div style='display: flex; justify-content: center; align-items: flex-end; text-align: center;'>"
-    for filepath, url, width, height in zip(filepaths, urls, widths, heights):
-        image_data = b64encode(open(filepath, "rb").read()).decode()
+    for filename, url, width, height in zip(filenames, urls, widths, heights):
         images_html += f"""
             <div style="margin: 10px;">
                 <a href="{url}">
-                    <img src="data:image/png;base64,{image_data}" style="width: {width}%; height: {height}%; object-fit: contain;">
+                    <img src="app/static/{filename}" style="width: {width}%; height: {height}%; object-fit: contain;">
                 </a>
             </div>"""
     images_html += "</div>"
@@ -225,14 +289,14 @@ If you'd like to report a bug, request a feature, or give us feedback, check out
 
         st.markdown("## Created by")
         _show_images_with_urls(
-            ["app/files/logo_malariagen.png"],
+            ["logo_malariagen.png"],
             ["https://www.malariagen.net/"],
             [70],
             [100]
         )
 
         _show_images_with_urls(
-            ["app/files/logo_gsu.png", "app/files/logo_sanger.png"],
+            ["logo_gsu.png", "logo_sanger.png"],
             ["https://www.sanger.ac.uk/collaboration/genomic-surveillance-unit/", "https://www.sanger.ac.uk/"],
             [130, 80],
             [130, 80]
@@ -242,7 +306,7 @@ If you'd like to report a bug, request a feature, or give us feedback, check out
 
         st.markdown("## Funded by")
         _show_images_with_urls(
-            ["app/files/logo_bmgf.png"],
+            ["logo_bmgf.png"],
             ["https://www.gatesfoundation.org/"],
             [60],
             [100]
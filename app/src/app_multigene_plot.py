@@ -0,0 +1,137 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly
+import plotly.graph_objects as go
+
+from src import data_store
+from src.aggregations import joint_haplotype_counts
+from src.utils import cache_load_population_colours, cache_load_gene_summaries, _cache_load_release_metadata, selected_release, cache_build_figure, generate_download_buttons, _cache_load_utility_mappers, _st_justify_markdown_html, priority_gene_ids
+
+# Most common multi-locus haplotypes shown individually in the plot, the rest are grouped together
+top_haplotypes = 10
+
+def _gene_labels(gene_names: list) -> list:
+    """
+    Short names of the genes for column names and labels, e.g. CRT for "PF3D7_0709000 - CRT", falling back to the
+    gene ID for genes sharing a name
+    """
+    labels = [gene_name.split(" - ")[-1] for gene_name in gene_names]
+    return [label if labels.count(label) == 1 else gene_name.split(" - ")[0] for label, gene_name in zip(labels, gene_names)]
+
+def _multilocus_samples(gene_labels, gene_data, sample_metadata):
+    """
+    One row per sample in the analysis set of every gene and homozygous at every gene, with its haplotype at each
+    gene, labelled by gene_labels, and its Population
+    """
+    df = pd.DataFrame({'Population': sample_metadata['Population'].astype(object).values})
+    included = np.ones(len(df), dtype = bool)
+
+    for gene_label, (_, codes, dictionary, _) in zip(gene_labels, gene_data):
+        df_samples = data_store.decode_gene_samples(codes, dictionary)
+        ns_changes = df_samples['ns_changes']
+        included &= ( df_samples['Exclusion reason'] == 'Analysis_set' ).values & ( ns_changes == ns_changes.str.upper() ).values
+        df[gene_label] = ns_changes.replace({'': '3D7 REF'}).values
+
+    return df.loc[included]
+
+def _build_multigene_figure(df_counts, gene_labels, populations):
+    """Stacked bars of the frequency of the most common multi-locus haplotypes in each population"""
+
+    population_totals = df_counts[populations].sum().replace(0, np.nan)
+    df_top = df_counts.head(top_haplotypes)
+
+    fig = go.Figure()
+    for rank, row in df_top.iterrows():
+        haplotype = "<br>".join(f"{gene_label}: {row[gene_label]}" for gene_label in gene_labels)
+        fig.add_trace(go.Bar(
+            x = populations,
+            y = (row[populations] / population_totals * 100).values,
+            name = f"#{rank + 1}",
+            marker = dict(color = plotly.colors.qualitative.D3[rank % len(plotly.colors.qualitative.D3)]),
+            customdata = row[populations].values,
+            hovertemplate = f"<b>#{rank + 1}</b><br>{haplotype}<br>%{{x}}: %{{y:0.1f}}% (%{{customdata}} samples)<extra></extra>"
+        ))
+
+    if len(df_counts) > top_haplotypes:
+        other = df_counts.iloc[top_haplotypes:][populations].sum()
+        fig.add_trace(go.Bar(
+            x = populations,
+            y = (other / population_totals * 100).values,
+            name = "Other",
+            marker = dict(color = "lightgrey"),
+            customdata = other.values,
+            hovertemplate = "<b>Other haplotypes</b><br>%{x}: %{y:0.1f}% (%{customdata} samples)<extra></extra>"
+        ))
+
+    fig.update_layout(
+        barmode = 'stack',
+        title = {
+            'text': f"<b>Pf-HaploAtlas multi-gene haplotypes: {', '.join(gene_labels)}</b>",
+            'x': 0.5,
+            'xanchor': 'center',
+            'font': {'size': 14}
+        },
+        xaxis = dict(title = "Population", fixedrange = True),
+        yaxis = dict(title = "Multi-locus haplotype frequency (%)", range = [0, 100], fixedrange = True),
+        legend = dict(title = "Haplotype"),
+        hovermode = 'closest',
+        margin = dict(t=50, b=50, l=80, r=5)
+    )
+
+    return fig
+
+def generate_multigene_plot(placeholder):
+    """Main function called in main.py to compare the haplotypes of a panel of genes"""
+
+    utility_mappers = _cache_load_utility_mappers()
+    gene_ids_to_gene_names = utility_mappers["gene_ids_to_gene_names"]
+
+    gene_names_selected = st.multiselect("Genes to compare",
+                                         [gene_ids_to_gene_names[gene_id] for gene_id in utility_mappers["gene_ids"]],
+                                         default = [gene_ids_to_gene_names[gene_id] for gene_id in priority_gene_ids if gene_id in gene_ids_to_gene_names],
+                                         max_selections = 8)
+    if len(gene_names_selected) < 2:
+        st.info("Select at least two genes to compare.")
+        st.stop()
+
+    placeholder.empty()
+
+    gene_ids = [utility_mappers["gene_names_to_gene_ids"][gene_name] for gene_name in gene_names_selected]
+    gene_labels = _gene_labels(gene_names_selected)
+
+    # The genes are loaded concurrently rather than one after the other
+    gene_data = cache_load_gene_summaries([utility_mappers["gene_ids_to_files"][gene_id] for gene_id in gene_ids])
+
+    df_samples = _multilocus_samples(gene_labels, gene_data, _cache_load_release_metadata(selected_release()))
+    if len(df_samples) == 0:
+        st.warning("No sample has a haplotype call for every gene selected.")
+        st.stop()
+
+    df_counts = joint_haplotype_counts(df_samples, gene_labels, 'Population')
+    populations = [pop for pop in cache_load_population_colours() if pop in df_counts.columns]
+
+    st.divider()
+    st.subheader(f"Multi-gene haplotypes: {', '.join(gene_labels)}")
+    _st_justify_markdown_html(f"""
+A multi-locus haplotype is the combination of a sample's haplotypes across the genes selected. {len(df_samples)} samples have a homozygous haplotype call for every gene selected, forming {len(df_counts)} different multi-locus haplotypes. The plot shows the frequency of the {top_haplotypes} most common ones in each population (see sidebar for details), which are listed in the table below. Hover your mouse over the data to see details.
+""")
+
+    # The figure only depends on the genes selected, so reruns that change anything else reuse it
+    figure_name = "_".join(gene_labels)
+    figure_key = tuple(gene_ids)
+    fig = cache_build_figure(figure_name, 4, figure_key, lambda: _build_multigene_figure(df_counts, gene_labels, populations))
+
+    st.plotly_chart(fig, config = {"displayModeBar": False})
+
+    generate_download_buttons(fig, figure_name, 600, 800, plot_number = 4, export_key = figure_key)
+
+    df_table = df_counts[gene_labels + ['Total'] + populations]
+    df_table.index = [f"#{rank + 1}" for rank in range(len(df_table))]
+    st.dataframe(df_table.head(top_haplotypes), use_container_width = True)
+
+    st.download_button("Download all multi-locus haplotypes",
+                       df_table.to_csv().encode('utf-8'),
+                       file_name = f'pf-haploatlas-{figure_name}_multigene_summary.csv',
+                       help = '''Explanation of columns: one column per gene with the haplotype of that gene; "Total" is the number of samples with the multi-locus haplotype; "SA", "AF-W", "AF-C", etc. shows number of samples observed with that multi-locus haplotype in each geographic distribution (see sidebar for details)''',
+                       use_container_width = True)
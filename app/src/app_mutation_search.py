@@ -0,0 +1,90 @@
+import streamlit as st
+import pandas as pd
+
+from src.utils import cache_load_population_colours, cache_load_gene_summary, _cache_load_mutation_index, _cache_load_utility_mappers, selected_release, _st_justify_markdown_html
+from src.precompute import slice_mutation_counts
+
+def _mutation_hits(df_counts, population, min_frequency, min_n, search):
+    """
+    The mutations above min_frequency (%) in population, as shown in the results table, indexed by their row in
+    df_counts. search filters them by gene ID, gene name or mutation, ignoring case
+    """
+    gene_ids_to_gene_names = _cache_load_utility_mappers()["gene_ids_to_gene_names"]
+
+    df_hits = slice_mutation_counts(df_counts, population, min_frequency / 100, min_n)
+    df_hits = df_hits.assign(gene_id = df_hits['gene_id'].astype(str))
+    df_hits['gene_name'] = df_hits['gene_id'].map(gene_ids_to_gene_names)
+
+    if search:
+        search = search.strip().lower()
+        matches = df_hits['gene_name'].str.lower().str.contains(search, regex = False) | ( df_hits['mutation'].str.lower() == search )
+        df_hits = df_hits.loc[matches]
+
+    return pd.DataFrame({
+        'Gene':                   "?gene_id=" + df_hits['gene_id'],
+        'Gene name':              df_hits['gene_name'],
+        'Mutation':               df_hits['mutation'],
+        'Samples with mutation':  df_hits['count'],
+        'Samples in population':  df_hits['n'],
+        'Frequency (%)':          df_hits['frequency'] * 100,
+    }, index = df_hits.index)
+
+def _show_haplotypes_carrying(df_hits, haplotype_rows, population):
+    """Lists the haplotypes of a gene carrying one of the mutations found, read from the gene's summary"""
+
+    row = st.selectbox("Show the haplotypes carrying a mutation", df_hits.index, index = None,
+                       format_func = lambda row: f"{df_hits.at[row, 'Gene name']}: {df_hits.at[row, 'Mutation']}",
+                       placeholder = "Choose a mutation from the table above")
+    if row is None:
+        return
+
+    gene_id = df_hits.at[row, 'Gene'].split("=")[-1]
+    filename = _cache_load_utility_mappers()["gene_ids_to_files"][gene_id]
+    df_haplotypes = cache_load_gene_summary(filename)[0]
+
+    df_carrying = df_haplotypes.iloc[haplotype_rows[row].values.to_numpy()][['ns_changes', 'Total', population]]
+    df_carrying = df_carrying.sort_values(population, ascending = False, kind = 'stable')
+    st.dataframe(df_carrying.set_index('ns_changes'), use_container_width = True)
+
+def generate_mutation_search(placeholder):
+    """Main function called in main.py to find the mutations of any gene by their frequency in a population"""
+
+    mutation_index = _cache_load_mutation_index(selected_release())
+    if mutation_index is None:
+        st.warning("Mutation search isn't available yet: the mutation index of this release hasn't been built. Run `python app/build_store.py mutation-index` to build it.")
+        st.stop()
+    df_counts, haplotype_rows = mutation_index
+
+    populations = [pop for pop in cache_load_population_colours() if pop in df_counts.columns]
+
+    col1, col2, col3 = st.columns(3)
+    population = col1.selectbox("Population", populations, help = "Geographic population of the samples, see sidebar for details")
+    min_frequency = col2.slider("Minimum frequency (%)", 0, 100, 50,
+                                help = "Only mutations carried by more than this percentage of the samples of the population are shown")
+    min_n = col3.number_input("Minimum samples", min_value = 1, value = 25,
+                              help = "Only genes with at least this number of samples in the population are searched, as frequencies from a few samples are unreliable")
+    search = st.text_input("Filter by gene or mutation", placeholder = "e.g. Kelch13, PF3D7_1343700 or C580Y")
+
+    placeholder.empty()
+
+    df_hits = _mutation_hits(df_counts, population, min_frequency, min_n, search)
+
+    st.divider()
+    st.subheader(f"Mutations above {min_frequency}% in {population}")
+    _st_justify_markdown_html(f"""
+{len(df_hits)} mutations across {df_hits['Gene'].nunique()} genes are carried by more than {min_frequency}% of the samples of {population}, counting the samples with a homozygous haplotype call for each gene. Click on a gene to open its haplotypes in a new tab, or choose a mutation below to list the haplotypes carrying it.
+""")
+
+    st.dataframe(df_hits, hide_index = True, use_container_width = True,
+                 column_config = {
+                     "Gene": st.column_config.LinkColumn("Gene", display_text = r"\?gene_id=(.*)"),
+                     "Frequency (%)": st.column_config.NumberColumn("Frequency (%)", format = "%.1f"),
+                 })
+
+    st.download_button("Download mutations",
+                       df_hits.assign(Gene = df_hits['Gene'].str.split("=").str[-1]).to_csv(index = False).encode('utf-8'),
+                       file_name = f'pf-haploatlas-mutations_{population}_{min_frequency}.csv',
+                       use_container_width = True)
+
+    if len(df_hits):
+        _show_haplotypes_carrying(df_hits, haplotype_rows, population)
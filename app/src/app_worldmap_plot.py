@@ -1,25 +1,10 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
-import collections
 
-from src.utils import cache_load_population_colours, generate_download_buttons, _cache_load_utility_mappers, _st_justify_markdown_html
-
-def _locations_agg(x, ns_changes):
-    """Aggregation function used to reformat dataframe in preparation for world map plot"""
-    names = collections.OrderedDict()
-    names['n'] = np.count_nonzero(x['ns_changes_homozygous'])
-    if names['n'] == 0:
-        names[f'frequency'] = 0
-        names['haplo_count'] = 0
-    else:
-        names['haplo_count'] = np.count_nonzero(( x['ns_changes'] == ns_changes))
-        names[f'frequency'] = names['haplo_count'] / names['n']
-
-    return pd.Series(names)
+from src.utils import cache_load_population_colours, cache_load_gene_artifact, cache_build_figure, generate_download_buttons, _cache_load_utility_mappers, _st_justify_markdown_html
+from src.precompute import slice_worldmap_index
 
 def _partial_frequency_marker_colour(freq: float) -> str:
     """
@@ -44,7 +29,8 @@ scatter_config = {
                            size=13,
                            symbol="circle-x",
                            line=dict(color='gray',
-                                     width=1))
+                                     width=1)),
+            "mode": "markers"
         },
         "full_frequency": {
             "marker": dict(color="black",
@@ -66,96 +52,10 @@ def _plotly_arrow(x0, x1, y):
 
     return a    
 
-def generate_worldmap_plot(ns_changes, df_join, min_samples, gene_id_selected):
-    """Main function called in main.py to generate and present the worldmap plot"""
-
-    st.divider()
-
-    st.subheader(f'3. World map plot: {ns_changes}')
-    _st_justify_markdown_html(f"""
-The world map plot displays the average haplotype frequency over an interval of time (in years) at a country-level on a global map. As above, the colour intensity of each “bead” corresponds to the frequency, and beads are coloured by geographic distribution (see sidebar for details). Hover your mouse over the data to see details. 
+def _build_worldmap_figure(df_frequencies, ns_changes, gene_name_selected):
+    """Builds the world map plot figure from the per country frequencies"""
 
-Adjust the slider below to choose your time interval of interest for calculating the proportion of samples containing the {ns_changes} haplotype: 
-""")
-    year = st.slider(' ', 1982, 2024, (2010, 2018))
     population_colours = cache_load_population_colours()
-    utility_mappers = _cache_load_utility_mappers()
-
-    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
-
-    ### Data pre-processing
-    # ideally, in the future, this part needs te be handled by data_formatter
-    if len(df_join) == 0:
-        st.warning("No haplotype data found.")
-        st.stop()
-    
-    # Filter QC fail and missing samples  
-    df_join= df_join[df_join['Exclusion reason'] == 'Analysis_set']
-
-    df_samples_with_ns_changes = df_join.copy()
-    # worldmap map requires iso_alpha values
-    plotly_worldmap_df = px.data.gapminder().query("year==2007")
-    iso_country_dict = dict(zip(plotly_worldmap_df['country'], plotly_worldmap_df['iso_alpha']))
-    df_samples_with_ns_changes.loc[:,'iso_alpha'] = df_samples_with_ns_changes['Country'].map(iso_country_dict)
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Papua New Guinea', 'iso_alpha'] = 'PNG'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Laos', 'iso_alpha'] = 'LAO'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Democratic Republic of the Congo', 'iso_alpha'] = 'COD'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Côte d'Ivoire", 'iso_alpha'] = 'CIV'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'South Sudan', 'iso_alpha'] = 'SSD'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Lao People's Democratic Republic", 'iso_alpha'] = 'LAO'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'United Republic of Tanzania', 'iso_alpha'] = 'TZA'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'The Gambia', 'iso_alpha'] = 'GMB'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Guyana', 'iso_alpha'] = 'GUY'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'DRC', 'iso_alpha'] = 'COD'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Solomon Islands', 'iso_alpha'] = 'SLB'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Vanuatu', 'iso_alpha'] = 'VUT'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Congo', 'iso_alpha'] = 'COG'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'French Guiana', 'iso_alpha'] = 'GUF'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Yemen', 'iso_alpha'] = 'YEM'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Suriname', 'iso_alpha'] = 'SUR'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Cape Verde', 'iso_alpha'] = 'CPV'
-    df_samples_with_ns_changes.loc[:,'iso_alpha'] = df_samples_with_ns_changes['iso_alpha'].astype(object)
-
-    # Fix for population of vietnam
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Vietnam", ['Population']] = 'AS-SE-E'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "India", ['Population']] = 'AS-S-E'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Kenya", ['Population']] = 'AF-E'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Thailand", ['Population']] = 'AS-SE-W'
-
-    # deal with encoding of 'wildtype' in literature dataset
-    if 'wildtype' in df_samples_with_ns_changes['ns_changes'].values:
-        df_samples_with_ns_changes.loc[df_samples_with_ns_changes['ns_changes'] == 'wildtype', 'ns_changes'] = ''
-
-    df_samples_with_ns_changes = df_samples_with_ns_changes.loc[df_samples_with_ns_changes['QC pass']]
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Democratic Republic of the Congo', ['Country']] = 'DRC'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'United Republic of Tanzania', ['Country']] = 'Tanzania'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == "Lao People's Democratic Republic", ['Country']] = 'Laos'
-    df_samples_with_ns_changes.loc[df_samples_with_ns_changes.ns_changes == "", "ns_changes"] = "3D7 REF"
-
-    df_samples_with_ns_changes['ns_changes_homozygous'] = ( df_samples_with_ns_changes['ns_changes'] == df_samples_with_ns_changes['ns_changes'].str.upper() )
-
-    # Use range slider to filter relative years in the dataframe
-    df_samples_with_ns_changes= df_samples_with_ns_changes[(df_samples_with_ns_changes['Year']>=year[0]) & (df_samples_with_ns_changes['Year']<=year[1])]
-    df_samples_with_ns_changes['Year-interval'] = str(year)
-
-    ### AGGREGATION     
-    if len(df_samples_with_ns_changes.groupby(['iso_alpha', 'Country', 'Year-interval', 'Population'])) == 0:
-        st.warning("No haplotype data found.")
-        st.stop()
-        
-    df_frequencies = (
-        df_samples_with_ns_changes
-        .groupby(['iso_alpha', 'Country', 'Year-interval', 'Population'])
-        .apply(lambda x: _locations_agg(x, ns_changes))
-        .reset_index()
-        .set_index(['Country'])
-        .reset_index())
-    
-    # only>min_samples 
-    df_frequencies = df_frequencies.loc[(df_frequencies['n'] >= min_samples)]
-
-    df_frequencies['frequency'] = np.round(df_frequencies['frequency']*100,2)
-    df_frequencies[['n', 'haplo_count']] = df_frequencies[['n', 'haplo_count']].astype('int')
 
     ### WORLDMAP PLOT (WORLD MAP)
 
@@ -175,11 +75,11 @@ Adjust the slider below to choose your time interval of interest for calculating
         go.Scatter(x = [0.4, 0.6], y = [0.6, 0.6], hoverinfo = "none", showlegend = False, mode = "text", text = ["0%", "100%"]),
         go.Scatter(x = [0.5], y = [0.9], hoverinfo = "none", showlegend = False, mode = "text", text = ["Haplotype Frequency"])] +
 
-        [_abacus_scatter(x = [pos], y = [legend_y], hoverinfo = "none",
-                         marker=dict(color = _partial_frequency_marker_colour(freq),
+        [_abacus_scatter(x = partial_frequency_positions, y = [legend_y] * len(partial_frequency_positions), hoverinfo = "none", mode = "markers",
+                         marker=dict(color = [_partial_frequency_marker_colour(freq) for freq in partial_frequency_frequencies],
                                      size = 16, symbol = "circle",
                                      line=dict(color='black', width=1.5))
-                        ) for pos, freq in zip(partial_frequency_positions, partial_frequency_frequencies)],
+                        )],
         
         rows = 1, cols = 1)
 
@@ -191,32 +91,47 @@ Adjust the slider below to choose your time interval of interest for calculating
                                 #    fixedrange=True,
                                    zeroline=False))
 
-    # Add worldmap plot (scattergeo subplot)
-    for _, row in df_frequencies.iterrows():
+    # Add worldmap plot (scattergeo subplot), one trace per bead style rather than one per country
+    hovertext = (
+        "<b>" + df_frequencies['Country'] + ": " + df_frequencies['Year-interval'].str.strip('()').str.replace(',', ' - ') + "</b>"
+        + "<br>Population: " + df_frequencies['Population']
+        + "<br>Samples with selected haplotype: " + df_frequencies['haplo_count'].astype(str) + " (" + df_frequencies['frequency'].astype(str) + "%) "
+        + "<br>Number of samples: " + df_frequencies['n'].astype(str) + "</b>"
+    )
+    bead_styles = {
+        "zero_frequency":    df_frequencies['frequency'] == 0,
+        "full_frequency":    df_frequencies['frequency'] == 100,
+        "partial_frequency": ( df_frequencies['frequency'] != 0 ) & ( df_frequencies['frequency'] != 100 ),
+    }
+
+    for style, beads in bead_styles.items():
+        if not beads.any():
+            continue
+
+        df_beads = df_frequencies.loc[beads]
+        if style == "zero_frequency":
+            symbol, colour = 'circle-x', 'white'
+        elif style == "full_frequency":
+            symbol, colour = 'circle', 'black'
+        else:
+            symbol, colour = 'circle', [_partial_frequency_marker_colour(freq) for freq in df_beads['frequency']]
+
         trace = go.Scattergeo(
-            locations=[row['iso_alpha']],
-            hoverinfo='text',
-            hovertemplate=f"<b>{row['Country']}: {row['Year-interval'].strip('()').replace(',', ' - ')}</b><br>Population: {row['Population']}<br>Samples with selected haplotype: {row['haplo_count']} ({row['frequency']}%) <br>Number of samples: {row['n']}</b><extra></extra>",
+            locations=df_beads['iso_alpha'].values,
+            text=hovertext.loc[beads].values,
+            hovertemplate="%{text}<extra></extra>",
+            mode="markers",
             marker=dict(
                 size=13,
+                symbol=symbol,
+                color=colour,
                 line=dict(
-                    color=population_colours[row['Population']],
+                    color=[population_colours[pop] for pop in df_beads['Population']],
                     width=1.35
                 )
             ), showlegend=False
         )
 
-        if row['frequency'] == 0:
-            trace.marker.symbol = 'circle-x'
-            trace.marker.color = 'white'
-        elif row['frequency'] == 100:
-            trace.marker.symbol = 'circle'
-            trace.mode = "markers+text"
-            trace.marker.color = 'black'
-        else:
-            trace.marker.symbol = 'circle'
-            trace.marker.color = _partial_frequency_marker_colour(row['frequency'])
-
         fig.add_trace(trace, row=2, col=1)
 
     # Update layout
@@ -235,6 +150,43 @@ Adjust the slider below to choose your time interval of interest for calculating
     )
     fig.update_geos(projection_type="natural earth")
 
+    return fig
+
+def generate_worldmap_plot(ns_changes, min_samples, gene_id_selected):
+    """Main function called in main.py to generate and present the worldmap plot"""
+
+    st.divider()
+
+    st.subheader(f'3. World map plot: {ns_changes}')
+    _st_justify_markdown_html(f"""
+The world map plot displays the average haplotype frequency over an interval of time (in years) at a country-level on a global map. As above, the colour intensity of each “bead” corresponds to the frequency, and beads are coloured by geographic distribution (see sidebar for details). Hover your mouse over the data to see details. 
+
+Adjust the slider below to choose your time interval of interest for calculating the proportion of samples containing the {ns_changes} haplotype: 
+""")
+    year = st.slider(' ', 1982, 2024, (2010, 2018))
+    utility_mappers = _cache_load_utility_mappers()
+
+    gene_name_selected = utility_mappers["gene_ids_to_gene_names"][gene_id_selected]
+
+    ### AGGREGATION
+    # Counts are cumulative over the years, so moving the slider only costs two lookups per country
+    df_frequencies = slice_worldmap_index(cache_load_gene_artifact(gene_id_selected, "worldmap"), ns_changes, year)
+
+    if len(df_frequencies) == 0:
+        st.warning("No haplotype data found.")
+        st.stop()
+    
+    # only>min_samples 
+    df_frequencies = df_frequencies.loc[(df_frequencies['n'] >= min_samples)]
+
+    df_frequencies['frequency'] = np.round(df_frequencies['frequency']*100,2)
+    df_frequencies[['n', 'haplo_count']] = df_frequencies[['n', 'haplo_count']].astype('int')
+
+    # The figure only depends on these settings, so reruns that change anything else reuse it
+    figure_key = (ns_changes, year, min_samples)
+    fig = cache_build_figure(gene_id_selected, 3, figure_key,
+                             lambda: _build_worldmap_figure(df_frequencies, ns_changes, gene_name_selected))
+
     st.plotly_chart(fig, config = {"displayModeBar": False})
 
-    generate_download_buttons(fig, gene_id_selected, 600, 800, plot_number = 3)
+    generate_download_buttons(fig, gene_id_selected, 600, 800, plot_number = 3, export_key = figure_key)
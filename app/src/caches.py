@@ -0,0 +1,267 @@
+"""
+Process-level caches of what every session shares: the releases, their gene indexes, sample metadata and mutation
+indexes, and the gene cache. These are plain functions which don't touch Streamlit, so they can be filled from any
+thread, e.g. by app/serve.py before the server has started. The app reads them through the wrappers in utils
+"""
+import concurrent.futures, functools, logging, os, threading, time
+import pandas as pd
+
+from src import data_store, metrics, precompute, shared_cache
+from src.gene_cache import GeneCache
+from src.gene_search import GeneSearch
+
+# Key drug resistance genes (DHFR-TS, MDR1, CRT, PPPK-DHPS, Kelch13) listed first in the gene selector
+priority_gene_ids = [
+    "PF3D7_0417200", "PF3D7_0523000", "PF3D7_0709000", "PF3D7_0810800", "PF3D7_1343700"
+]
+
+def _process_cache(function):
+    """
+    functools.lru_cache, except that concurrent callers wait for the first one to compute a value rather than
+    computing it again, as st.cache_resource does. Exceptions aren't cached, the next call tries again
+    """
+    cached = functools.lru_cache(maxsize = None)(function)
+    lock = threading.RLock()
+
+    @functools.wraps(function)
+    def _cached(*args):
+        with lock:
+            return cached(*args)
+
+    _cached.cache_clear = cached.cache_clear
+    return _cached
+
+@_process_cache
+def load_releases():
+    """The data releases the app serves, the first being the default (see data_store.load_releases)"""
+    return data_store.load_releases()
+
+@_process_cache
+def load_gene_index(release_id: str):
+    """The gene index of a release (see data_store.compute_gene_index). Callers must not modify it in place"""
+    release = load_releases()[release_id]
+    return data_store.load_gene_index(release["pkl_path"], release["store_path"], release["gene_names_path"], release["job_logs_path"])
+
+@_process_cache
+def load_release_mappers(release_id: str):
+    """
+    Loads various useful dictionaries and lists related to handling gene IDs and converting
+    back and forth between gene IDs and gene names etc., for the genes of one release
+    """
+    gene_index = load_gene_index(release_id)
+
+    gene_ids_to_files = dict(zip(gene_index["gene_id"], gene_index["filename"]))
+
+    gene_ids_to_gene_names = dict(zip(gene_index["gene_id"], gene_index["display_name"]))
+
+    gene_names_to_gene_ids = dict(zip(gene_ids_to_gene_names.values(), gene_ids_to_gene_names.keys()))
+
+    gene_ids = list(gene_index["gene_id"]) # before core genes identified: if _is_core_genome(gene_name)
+
+    return {
+        "gene_ids_to_files": gene_ids_to_files,
+        "gene_ids_to_gene_names": gene_ids_to_gene_names,
+        "gene_names_to_gene_ids": gene_names_to_gene_ids,
+        "gene_ids": gene_ids
+    }
+
+@_process_cache
+def load_gene_search(release_id: str):
+    """The gene search index of a release (see gene_search.GeneSearch), built from its gene index"""
+    gene_index = load_gene_index(release_id)
+    return GeneSearch(gene_index["gene_id"], gene_index["gene_name"])
+
+@_process_cache
+def load_job_logs(release_id: str):
+    """
+    The job log sample counts of every gene of a release (see data_store.job_log_columns) by gene ID, leaving out
+    missing counts. Built once from the gene index so that looking up a gene is a dictionary lookup
+    """
+    gene_index = load_gene_index(release_id)
+    records = gene_index[data_store.job_log_columns].to_dict("records")
+    return {
+        gene_id: {column: int(value) for column, value in record.items() if pd.notna(value)}
+            for gene_id, record in zip(gene_index["gene_id"], records)
+    }
+
+@_process_cache
+def load_release_metadata(release_id: str):
+    """
+    Loads the typed sample metadata of a release, shared by every session as one (memory-mapped) dataframe rather
+    than a copy each, so callers must not modify it in place
+    """
+    release = load_releases()[release_id]
+    metadata_path = release["metadata_path"]
+    if not os.path.exists(metadata_path):
+        # The spreadsheet is then parsed once per host rather than once per process, see get_shared_cache
+        shared_path = get_shared_cache().path("metadata", [release["metadata_xlsx_path"]],
+                                              lambda path: data_store.convert_metadata(release["metadata_xlsx_path"], f"{path}/metadata.arrow"))
+        if shared_path is not None:
+            metadata_path = f"{shared_path}/metadata.arrow"
+
+    return data_store.load_sample_metadata(metadata_path, release["metadata_xlsx_path"])
+
+@_process_cache
+def get_shared_cache():
+    """
+    Cache of decoded gene summaries, sample metadata and computed artifacts shared by every app process on the host
+    (see shared_cache.DiskCache), in the directory set through the HAPLOATLAS_SHARED_CACHE environment variable. Only
+    used for what hasn't been built into the release's store. Without it each process decodes and computes these itself
+    """
+    cache = shared_cache.open_shared_cache(os.environ.get("HAPLOATLAS_SHARED_CACHE"))
+    metrics.register_collector("shared_cache", cache.stats)
+    return cache
+
+@_process_cache
+def load_mutation_index(release_id: str):
+    """
+    The cross-gene mutation index of a release (see data_store.load_mutation_index) as (df_counts, haplotype_rows),
+    or None if it hasn't been built. df_counts has every column but haplotype_rows, which is kept as an Arrow column
+    and only read for the mutations looked at. Callers must not modify it in place
+    """
+    table = data_store.load_mutation_index(load_releases()[release_id]["store_path"])
+    if table is None:
+        return None
+    return table.drop(["haplotype_rows"]).to_pandas(), table.column("haplotype_rows")
+
+@_process_cache
+def get_gene_cache():
+    """
+    Process-wide cache of loaded gene summaries, keyed by release and gene ID. Unlike st.cache_data it is bounded by
+    a memory budget, set in MB through the HAPLOATLAS_GENE_CACHE_MB environment variable, and evicts the least
+    recently used genes first. The priority genes are never evicted
+    """
+    gene_cache = GeneCache(
+        max_bytes = int(os.environ.get("HAPLOATLAS_GENE_CACHE_MB", 512)) * 2**20,
+        pinned    = [(release_id, gene_id) for release_id in load_releases() for gene_id in priority_gene_ids]
+    )
+    metrics.register_collector("gene_cache", gene_cache.stats)
+    return gene_cache
+
+def gene_data_loader(release_id: str):
+    """
+    Returns a function loading a gene summary of a release based on provided file name, from the release's columnar
+    store and haplotype matrix when they have been built (see app/build_store.py) and from the original lzma-pickle
+    file otherwise. The sample-level data is kept as one int column of codes plus a small dictionary. Caches the
+    objects in the gene cache when first loaded
+    """
+    release = load_releases()[release_id]
+    gene_cache = get_gene_cache()
+    shared = get_shared_cache()
+
+    def _load_gene_summary(filename: str):
+        gene_id = filename.split(".")[0]
+        # A gene missing from the release's store is converted into the shared cache, if there is one, so that its
+        # lzma-pickle file is decoded once per host, and its sample codes are memory-mapped by every process
+        if not data_store.is_gene_converted(gene_id, release["store_path"]):
+            shared_path = shared.path("gene_codes", [f'{release["pkl_path"]}/{filename}'],
+                                      lambda path: data_store.convert_gene_codes(filename, release["pkl_path"], path))
+            if shared_path is not None:
+                return data_store.load_gene_codes_summary(gene_id, shared_path)
+        return data_store.load_gene_summary(filename, release["pkl_path"], release["store_path"])
+
+    def _load_gene_data(filename: str):
+        gene_id = filename.split(".")[0]
+        return gene_cache.get((release_id, gene_id), lambda: _load_gene_summary(filename))
+
+    return _load_gene_data
+
+def load_gene_data(filename: str, release_id: str):
+    return gene_data_loader(release_id)(filename)
+
+def load_gene_summary(filename: str, release_id: str):
+    """
+    Loads the relevant gene summary and joins the sample-level haplotypes onto the shared sample metadata.
+    df_haplotypes is the cached dataframe shared between sessions, so callers must not modify it in place
+    """
+    df_haplotypes, codes, dictionary, background_ns_changes = load_gene_data(filename, release_id)
+    df_join = data_store.join_sample_metadata(codes, dictionary, load_release_metadata(release_id))
+    return df_haplotypes, df_join, background_ns_changes
+
+def load_gene_artifact(gene_id: str, name: str, release_id: str):
+    """
+    Loads one of the gene's precomputed artifacts, e.g. its abacus counts (see precompute.artifact_builders), computing
+    it on first use if it hasn't been built by app/build_store.py, once per host when there is a shared cache
+    """
+    def _load_gene_artifact():
+        release = load_releases()[release_id]
+        version = precompute.artifact_versions[name]
+        artifact = data_store.load_gene_artifact(gene_id, name, version, release["store_path"])
+        if artifact is not None:
+            return artifact
+
+        filename = load_release_mappers(release_id)["gene_ids_to_files"][gene_id]
+        def _compute_gene_artifact():
+            df_haplotypes, df_join, _ = load_gene_summary(filename, release_id)
+            return precompute.artifact_builders[name](df_join, df_haplotypes)
+
+        # Computed once per host when there is a shared cache, keyed by everything the artifact is computed from
+        sources = [*data_store.gene_summary_sources(filename, release["pkl_path"], release["store_path"]),
+                   release["metadata_path"] if os.path.exists(release["metadata_path"]) else release["metadata_xlsx_path"],
+                   precompute.__file__]
+        shared_path = get_shared_cache().path(f"artifacts/{name}", sources,
+                                              lambda path: data_store.write_gene_artifact(gene_id, name, _compute_gene_artifact(), version, path))
+        if shared_path is not None:
+            artifact = data_store.load_gene_artifact(gene_id, name, version, shared_path)
+            if artifact is not None:
+                return artifact
+        return _compute_gene_artifact()
+
+    return get_gene_cache().get((release_id, gene_id, name), _load_gene_artifact)
+
+@_process_cache
+def start_metrics_server():
+    """
+    Starts the /metrics endpoint once per process if HAPLOATLAS_METRICS_PORT is set. If the port is taken, e.g. by
+    another replica on the host, the process runs without metrics rather than failing every rerun
+    """
+    port = os.environ.get("HAPLOATLAS_METRICS_PORT")
+    if port:
+        try:
+            metrics.start_metrics_server(int(port))
+        except OSError as error:
+            logging.getLogger(__name__).warning(f"Not serving metrics, port {port} is unavailable: {error}")
+
+def warm_up_caches() -> int:
+    """
+    Loads what the first users would otherwise wait for, for every release: the gene index and the mappings, search
+    index and job logs built from it, the sample metadata, the mutation index, and the priority genes with their
+    artifacts, in parallel. Returns the number of these which failed, which are then loaded on first use instead
+    """
+    tasks = []
+    for release_id in load_releases():
+        tasks += [functools.partial(load_release_mappers, release_id), functools.partial(load_gene_search, release_id),
+                  functools.partial(load_job_logs, release_id), functools.partial(load_release_metadata, release_id),
+                  functools.partial(load_mutation_index, release_id)]
+        tasks += [functools.partial(_warm_up_gene, gene_id, release_id) for gene_id in priority_gene_ids]
+
+    # Not the app's loader pool, which sessions may need in the meantime
+    with concurrent.futures.ThreadPoolExecutor(max_workers = int(os.environ.get("HAPLOATLAS_LOADER_THREADS", 4)),
+                                               thread_name_prefix = "warm-up") as executor:
+        futures = [executor.submit(task) for task in tasks]
+    return sum(future.exception() is not None for future in futures)
+
+def _warm_up_gene(gene_id: str, release_id: str):
+    filename = load_release_mappers(release_id)["gene_ids_to_files"].get(gene_id)
+    if filename is None:
+        return
+    load_gene_data(filename, release_id)
+    for name in precompute.artifact_builders:
+        load_gene_artifact(gene_id, name, release_id)
+
+@_process_cache
+def start_warm_up():
+    """
+    Runs warm_up_caches once per process in the background, then marks the process as ready (see metrics.set_ready).
+    Started by app/serve.py before the server starts, or else by the first session
+    """
+    stats = {"seconds": 0, "failures": 0}
+    metrics.register_collector("warm_up", lambda: {"ready": int(metrics.is_ready()), **stats})
+
+    def _warm_up():
+        started = time.time()
+        stats["failures"] = warm_up_caches()
+        stats["seconds"] = round(time.time() - started, 1)
+        metrics.set_ready()
+
+    threading.Thread(target = _warm_up, name = "warm-up", daemon = True).start()
@@ -0,0 +1,462 @@
+import json, os, lzma, pickle, functools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+pkl_path = "app/files/2024-06-24_pkl_files"
+store_path = "app/files/2024-06-24_arrow_files"
+metadata_xlsx_path = "app/files/Pf7_metadata.xlsx"
+metadata_path = "app/files/Pf7_metadata.arrow"
+countries_path = "app/files/countries.json"
+releases_path = "app/files/releases.json"
+gene_names_path = "app/files/gene_mapping.json"
+job_logs_path = "app/files/job_logs.json"
+regions_path = "app/files/regions-20130225.onebased.txt"
+
+_metadata_categorical_columns = ["Country", "Population", "Admin level 1", "Exclusion reason"]
+
+# Columns joined onto the sample metadata from the country table, see load_country_table
+country_columns = ["iso_alpha", "Country display name", "Country majority population"]
+
+# Paths every release defines in releases.json
+release_paths = ["pkl_path", "store_path", "metadata_xlsx_path", "metadata_path", "gene_names_path", "job_logs_path"]
+
+def load_releases(releases_path = releases_path) -> dict:
+    """
+    The MalariaGEN data releases the app can serve, by release ID, in the order they are offered, the first being
+    the default. Each release has a display name and its own release_paths, so releases never share a store. Falls
+    back to the Pf7 files when there is no registry
+    """
+    if not os.path.exists(releases_path):
+        return {"Pf7": {"name": "Pf7", "pkl_path": pkl_path, "store_path": store_path, "metadata_xlsx_path": metadata_xlsx_path, "metadata_path": metadata_path,
+                        "gene_names_path": gene_names_path, "job_logs_path": job_logs_path}}
+
+    with open(releases_path, "r") as file:
+        releases = json.load(file)
+
+    for release_id, release in releases.items():
+        missing = [path for path in release_paths if path not in release]
+        if missing:
+            raise ValueError(f"Release {release_id} in {releases_path} is missing {', '.join(missing)}")
+    return {release_id: {"name": release_id, **release} for release_id, release in releases.items()}
+
+def _haplotypes_file(gene_id: str, store_path = store_path) -> str:
+    return f"{store_path}/{gene_id}_haplotypes.arrow"
+
+def _samples_file(gene_id: str, store_path = store_path) -> str:
+    return f"{store_path}/{gene_id}_samples.arrow"
+
+def _haplotype_matrix_file(store_path = store_path) -> str:
+    return f"{store_path}/haplotype_matrix.arrow"
+
+def _haplotype_codes_file(store_path = store_path) -> str:
+    return f"{store_path}/haplotype_codes.arrow"
+
+def _gene_codes_file(gene_id: str, store_path = store_path) -> str:
+    return f"{store_path}/{gene_id}_codes.arrow"
+
+def _gene_dictionary_file(gene_id: str, store_path = store_path) -> str:
+    return f"{store_path}/{gene_id}_dictionary.arrow"
+
+def _write_table_atomically(table: pa.Table, path: str, compression = "lz4"):
+    """Writes to a temporary file first so that a half-written file is never picked up by the app"""
+    tmp_path = f"{path}.tmp"
+    feather.write_feather(table, tmp_path, compression = compression)
+    os.replace(tmp_path, path)
+
+def _read_table(path: str, columns = None) -> pa.Table:
+    return feather.read_table(path, columns = columns, memory_map = True)
+
+def load_pickled_gene_summary(filename: str, pkl_path = pkl_path):
+    """Loads the original lzma-pickle gene summary: (df_haplotypes, df_join, background_ns_changes, gene_name)"""
+    with lzma.open(f'{pkl_path}/{filename}', 'rb') as file:
+        return pickle.load(file)
+
+def is_gene_converted(gene_id: str, store_path = store_path) -> bool:
+    return os.path.exists(_haplotypes_file(gene_id, store_path)) and os.path.exists(_samples_file(gene_id, store_path))
+
+def _haplotypes_table(df_haplotypes: pd.DataFrame, background_ns_changes, gene_name) -> pa.Table:
+    """df_haplotypes, with the scalar background_ns_changes and gene name kept in the schema metadata"""
+    haplotypes_table = pa.Table.from_pandas(df_haplotypes, preserve_index = True)
+    return haplotypes_table.replace_schema_metadata({
+        **haplotypes_table.schema.metadata,
+        b"pf_haploatlas": json.dumps({
+            "background_ns_changes": background_ns_changes,
+            "gene_name": gene_name,
+        }).encode()
+    })
+
+def convert_gene_summary(filename: str, pkl_path = pkl_path, store_path = store_path):
+    """
+    One-time conversion of a `<gene>.pkl.xz` file into two Arrow IPC (Feather v2) files, one for
+    df_haplotypes and one for df_join. The scalar background_ns_changes and gene name are kept in the
+    schema metadata of the haplotypes file
+    """
+    gene_id = filename.split(".")[0]
+    df_haplotypes, df_join, background_ns_changes, gene_name = load_pickled_gene_summary(filename, pkl_path)
+
+    os.makedirs(store_path, exist_ok = True)
+
+    _write_table_atomically(_haplotypes_table(df_haplotypes, background_ns_changes, gene_name), _haplotypes_file(gene_id, store_path))
+
+    # Dictionary-encoded, as the same few haplotype strings repeat across all 20k samples
+    samples_table = pa.Table.from_pandas(df_join.astype("category"), preserve_index = False)
+    _write_table_atomically(samples_table, _samples_file(gene_id, store_path))
+
+def convert_gene_codes(filename: str, pkl_path = pkl_path, store_path = store_path):
+    """
+    Converts a `<gene>.pkl.xz` file like convert_gene_summary, but keeps the samples as their codes and dictionary
+    (see encode_gene_samples), and writes every file uncompressed so that processes memory-map them and share their
+    pages. The codes are then read zero-copy, like a column of the haplotype matrix. Used for the shared cache, see
+    load_gene_codes_summary
+    """
+    gene_id = filename.split(".")[0]
+    df_haplotypes, df_join, background_ns_changes, gene_name = load_pickled_gene_summary(filename, pkl_path)
+
+    os.makedirs(store_path, exist_ok = True)
+
+    _write_table_atomically(_haplotypes_table(df_haplotypes, background_ns_changes, gene_name), _haplotypes_file(gene_id, store_path),
+                            compression = "uncompressed")
+
+    codes, dictionary = encode_gene_samples(df_join)
+    _write_table_atomically(pa.table({"codes": codes}), _gene_codes_file(gene_id, store_path), compression = "uncompressed")
+    dictionary_schema = pa.schema([(column, pa.string()) for column in _sample_columns])
+    _write_table_atomically(pa.Table.from_pandas(dictionary, schema = dictionary_schema, preserve_index = False),
+                            _gene_dictionary_file(gene_id, store_path), compression = "uncompressed")
+
+def load_gene_haplotypes(gene_id: str, columns = None, store_path = store_path):
+    """
+    Reads df_haplotypes for a converted gene, optionally restricted to a subset of columns.
+    Returns the dataframe along with background_ns_changes
+    """
+    table = _read_table(_haplotypes_file(gene_id, store_path), columns)
+    extras = json.loads(table.schema.metadata[b"pf_haploatlas"])
+
+    df_haplotypes = table.to_pandas()
+    if "ns_changes_list" in df_haplotypes.columns:
+        # Arrow hands list columns back as numpy arrays, the plots expect python lists
+        df_haplotypes["ns_changes_list"] = df_haplotypes["ns_changes_list"].map(list)
+
+    return df_haplotypes, extras["background_ns_changes"]
+
+def load_gene_samples(gene_id: str, columns = None, store_path = store_path) -> pd.DataFrame:
+    """Reads df_join for a converted gene, optionally restricted to a subset of columns"""
+    return _read_table(_samples_file(gene_id, store_path), columns).to_pandas().astype(object)
+
+def type_metadata(pf7_metadata: pd.DataFrame) -> pd.DataFrame:
+    """Converts the columns of the raw Pf7 sample metadata into compact dtypes"""
+    pf7_metadata = pf7_metadata.astype({column: "category" for column in _metadata_categorical_columns})
+    pf7_metadata["Year"] = pf7_metadata["Year"].astype("Int16") # nullable, a handful of samples have no year
+    pf7_metadata["QC pass"] = pf7_metadata["QC pass"].astype(bool)
+    return pf7_metadata
+
+def convert_metadata(metadata_xlsx_path = metadata_xlsx_path, metadata_path = metadata_path):
+    """
+    One-time conversion of the Pf7 metadata spreadsheet into a typed Arrow IPC file. The file is written
+    uncompressed so that it can be memory-mapped and shared between server processes
+    """
+    pf7_metadata = type_metadata(pd.read_excel(metadata_xlsx_path))
+    table = pa.Table.from_pandas(pf7_metadata, preserve_index = False)
+    _write_table_atomically(table, metadata_path, compression = "uncompressed")
+
+def load_metadata(columns = None, metadata_path = metadata_path, metadata_xlsx_path = metadata_xlsx_path) -> pd.DataFrame:
+    """Reads the typed Pf7 metadata, from the Arrow IPC file if it has been built and from the spreadsheet otherwise"""
+    if not os.path.exists(metadata_path):
+        pf7_metadata = type_metadata(pd.read_excel(metadata_xlsx_path))
+        return pf7_metadata if columns is None else pf7_metadata[columns]
+
+    # split_blocks avoids consolidating the memory-mapped columns into fresh 2D blocks
+    return _read_table(metadata_path, columns).to_pandas(split_blocks = True)
+
+def load_country_table(pf7_metadata: pd.DataFrame, countries_path = countries_path) -> pd.DataFrame:
+    """
+    One row per Pf7 country with its ISO alpha-3 code and display name, from countries.json, and the population
+    most of its samples belong to, which the world map uses to colour countries spanning two populations
+    """
+    with open(countries_path, "r") as file:
+        countries = json.load(file)
+
+    country_table = pd.DataFrame.from_dict(countries, orient = "index").rename(columns = {"display_name": "Country display name"})
+    majority_population = pd.crosstab(pf7_metadata["Country"], pf7_metadata["Population"]).idxmax(axis = 1)
+
+    country_table = country_table.reindex(majority_population.index.astype(str))
+    country_table["Country display name"] = country_table["Country display name"].fillna(country_table.index.to_series())
+    country_table["Country majority population"] = majority_population.astype(str).values
+    return country_table[country_columns]
+
+def join_country_table(pf7_metadata: pd.DataFrame, countries_path = countries_path) -> pd.DataFrame:
+    """Adds the country_columns to the Pf7 metadata as categoricals, missing for samples without a country"""
+    country_table = load_country_table(pf7_metadata, countries_path)
+    rows = country_table.reindex(pf7_metadata["Country"].astype(object))
+    for column in country_columns:
+        pf7_metadata[column] = pd.Categorical(rows[column].values)
+    return pf7_metadata
+
+def load_sample_metadata(metadata_path = metadata_path, metadata_xlsx_path = metadata_xlsx_path) -> pd.DataFrame:
+    """
+    The Pf7 metadata as joined onto each gene's samples, the gene-specific exclusion reason replacing the Pf7 one,
+    with the country table joined in
+    """
+    pf7_metadata = load_metadata(metadata_path = metadata_path, metadata_xlsx_path = metadata_xlsx_path).drop('Exclusion reason', axis=1)
+    return join_country_table(pf7_metadata).reset_index()
+
+# ============================================================================================================================================================
+# Genome-wide haplotype matrix
+#
+# Every gene's df_join has one row per Pf7 sample, in the same order as the metadata, holding the gene-specific
+# exclusion reason and ns_changes. Rather than keeping a copy of that frame per gene, each gene is stored as a single
+# int16 column of codes into a small per-gene dictionary of (Exclusion reason, ns_changes) pairs.
+# ============================================================================================================================================================
+
+_sample_columns = ["Exclusion reason", "ns_changes"]
+
+def encode_gene_samples(df_join: pd.DataFrame):
+    """Encodes df_join as an int16 code per sample plus the dictionary of distinct (Exclusion reason, ns_changes) rows"""
+    codes, uniques = pd.factorize(pd.MultiIndex.from_frame(df_join[_sample_columns]))
+    dictionary = pd.DataFrame(list(uniques), columns = _sample_columns)
+    return codes.astype(np.int16), dictionary
+
+def decode_gene_samples(codes: np.ndarray, dictionary: pd.DataFrame) -> pd.DataFrame:
+    """Inverse of encode_gene_samples, giving back df_join"""
+    return dictionary.take(codes).reset_index(drop = True)
+
+def join_sample_metadata(codes: np.ndarray, dictionary: pd.DataFrame, sample_metadata: pd.DataFrame) -> pd.DataFrame:
+    """Decodes a gene's samples and joins them onto the output of load_sample_metadata, giving the df_join used by the plots"""
+    return pd.concat([decode_gene_samples(codes, dictionary).reset_index(), sample_metadata], axis=1)
+
+def build_haplotype_matrix(filenames, pkl_path = pkl_path, store_path = store_path, progress = None):
+    """
+    Builds the genome-wide sample x gene matrix of haplotype codes, plus the per-gene dictionaries. The matrix is
+    written uncompressed so that loading a gene is a zero-copy read of one memory-mapped column. The dictionaries are
+    written as one record batch per gene, in the same order as the matrix columns, so a gene's dictionary can be
+    read without decompressing anyone else's
+    """
+    os.makedirs(store_path, exist_ok = True)
+    codes_path = _haplotype_codes_file(store_path)
+    codes_schema = pa.schema([(column, pa.string()) for column in _sample_columns])
+
+    columns = {}
+    with pa.ipc.new_file(f"{codes_path}.tmp", codes_schema, options = pa.ipc.IpcWriteOptions(compression = "lz4")) as writer:
+        for i, filename in enumerate(filenames, start = 1):
+            gene_id = filename.split(".")[0]
+            if is_gene_converted(gene_id, store_path):
+                df_join = load_gene_samples(gene_id, columns = _sample_columns, store_path = store_path)
+            else:
+                df_join = load_pickled_gene_summary(filename, pkl_path)[1]
+
+            codes, dictionary = encode_gene_samples(df_join)
+            columns[gene_id] = codes
+            writer.write_batch(pa.RecordBatch.from_pandas(dictionary, schema = codes_schema, preserve_index = False))
+
+            if progress is not None:
+                progress(i)
+
+    _write_table_atomically(pa.table(columns), _haplotype_matrix_file(store_path), compression = "uncompressed")
+    os.replace(f"{codes_path}.tmp", codes_path)
+
+def _map_record_batch(path: str) -> pa.RecordBatch:
+    """The memory-mapped contents of an uncompressed Arrow file as one record batch, whose columns are read zero-copy"""
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    if reader.num_record_batches != 1:
+        return reader.read_all().combine_chunks().to_batches()[0]
+    return reader.get_batch(0)
+
+@functools.lru_cache(maxsize = None)
+def _open_haplotype_matrix(path: str) -> pa.RecordBatch:
+    return _map_record_batch(path)
+
+@functools.lru_cache(maxsize = None)
+def _open_haplotype_codes(path: str) -> pa.ipc.RecordBatchFileReader:
+    return pa.ipc.open_file(pa.memory_map(path))
+
+def is_gene_in_haplotype_matrix(gene_id: str, store_path = store_path) -> bool:
+    path = _haplotype_matrix_file(store_path)
+    return os.path.exists(path) and gene_id in _open_haplotype_matrix(path).schema.names
+
+def load_gene_codes(gene_id: str, store_path = store_path):
+    """Reads one gene's column of the haplotype matrix and its dictionary"""
+    batch = _open_haplotype_matrix(_haplotype_matrix_file(store_path))
+    column_index = batch.schema.get_field_index(gene_id)
+    codes = batch.column(column_index).to_numpy()
+    dictionary = _open_haplotype_codes(_haplotype_codes_file(store_path)).get_batch(column_index).to_pandas()
+    return codes, dictionary
+
+def load_gene_summary(filename: str, pkl_path = pkl_path, store_path = store_path):
+    """
+    Loads a gene summary from the best available source: the haplotype matrix and columnar store when they have
+    been built, otherwise the original lzma-pickle file. Returns (df_haplotypes, codes, dictionary, background_ns_changes),
+    see encode_gene_samples
+    """
+    gene_id = filename.split(".")[0]
+
+    if is_gene_converted(gene_id, store_path):
+        df_haplotypes, background_ns_changes = load_gene_haplotypes(gene_id, store_path = store_path)
+        if is_gene_in_haplotype_matrix(gene_id, store_path):
+            codes, dictionary = load_gene_codes(gene_id, store_path)
+        else:
+            codes, dictionary = encode_gene_samples(load_gene_samples(gene_id, columns = _sample_columns, store_path = store_path))
+    else:
+        df_haplotypes, df_join, background_ns_changes, _ = load_pickled_gene_summary(filename, pkl_path)
+        codes, dictionary = encode_gene_samples(df_join)
+
+    return df_haplotypes, codes, dictionary, background_ns_changes
+
+def load_gene_codes_summary(gene_id: str, store_path = store_path):
+    """
+    Loads a gene summary converted by convert_gene_codes, as load_gene_summary does. The codes are a view of the
+    memory-mapped file, which stays mapped as long as they are referenced
+    """
+    df_haplotypes, background_ns_changes = load_gene_haplotypes(gene_id, store_path = store_path)
+    codes = _map_record_batch(_gene_codes_file(gene_id, store_path)).column(0).to_numpy()
+    dictionary = _read_table(_gene_dictionary_file(gene_id, store_path)).to_pandas()
+    return df_haplotypes, codes, dictionary, background_ns_changes
+
+def gene_summary_sources(filename: str, pkl_path = pkl_path, store_path = store_path) -> list:
+    """The files load_gene_summary reads the gene summary from"""
+    gene_id = filename.split(".")[0]
+    if not is_gene_converted(gene_id, store_path):
+        return [f'{pkl_path}/{filename}']
+    if is_gene_in_haplotype_matrix(gene_id, store_path):
+        return [_haplotypes_file(gene_id, store_path), _haplotype_matrix_file(store_path), _haplotype_codes_file(store_path)]
+    return [_haplotypes_file(gene_id, store_path), _samples_file(gene_id, store_path)]
+
+# ============================================================================================================================================================
+# Derived per-gene artifacts (see src/precompute.py), stored as dictionaries of numpy arrays
+# ============================================================================================================================================================
+
+def _artifact_file(gene_id: str, name: str, store_path = store_path) -> str:
+    return f"{store_path}/{gene_id}_{name}.npz"
+
+# Stored alongside an artifact's arrays, see precompute.artifact_versions
+_artifact_version_key = "_version"
+
+def is_gene_artifact_built(gene_id: str, name: str, version: int, store_path = store_path) -> bool:
+    """Whether the artifact is in the store, built by the given version of its builder"""
+    path = _artifact_file(gene_id, name, store_path)
+    if not os.path.exists(path):
+        return False
+    with np.load(path, allow_pickle = False) as npz:
+        return _artifact_version_key in npz.files and int(npz[_artifact_version_key]) == version
+
+def write_gene_artifact(gene_id: str, name: str, arrays: dict, version: int, store_path = store_path):
+    os.makedirs(store_path, exist_ok = True)
+    path = _artifact_file(gene_id, name, store_path)
+    with open(f"{path}.tmp", "wb") as file:
+        np.savez_compressed(file, **arrays, **{_artifact_version_key: np.array(version)})
+    os.replace(f"{path}.tmp", path)
+
+def load_gene_artifact(gene_id: str, name: str, version: int, store_path = store_path):
+    """
+    Returns the stored artifact as a dictionary of arrays, or None if it hasn't been built, or was built by another
+    version of its builder and would be out of date
+    """
+    path = _artifact_file(gene_id, name, store_path)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle = False) as npz:
+        artifact = dict(npz)
+    if int(artifact.pop(_artifact_version_key, -1)) != version:
+        return None
+    return artifact
+
+# ============================================================================================================================================================
+# Gene index
+#
+# One row per gene of a release, with everything the app needs to know about a gene before loading it, so that startup
+# is a single read rather than a directory listing plus a couple of JSON files
+# ============================================================================================================================================================
+
+# Per-gene sample counts from the haplotype calling jobs, see job_logs.json
+job_log_columns = ["c_exc_s", "c_inc_s", "c_missing", "c_het_calls", "c_stop_codon", "c_unq_h"]
+
+def _gene_index_file(store_path = store_path) -> str:
+    return f"{store_path}/gene_index.arrow"
+
+def _load_chromosomes(regions_path = regions_path) -> list:
+    with open(regions_path, "r") as file:
+        return sorted(set(line.split("\t")[0] for line in file if line.strip()))
+
+def compute_gene_index(pkl_path = pkl_path, gene_names_path = gene_names_path, job_logs_path = job_logs_path,
+                       regions_path = regions_path) -> pd.DataFrame:
+    """
+    Builds the gene index of the genes in pkl_path, sorted by gene ID: the gene's file, its name ("." when it has
+    none) and display name as shown in the gene selector, its chromosome, as named in the regions file, and the
+    job_log_columns, missing for genes without job logs
+    """
+    filenames = sorted(f for f in os.listdir(pkl_path) if f.endswith("pkl.xz"))
+    gene_ids = [f.split(".")[0] for f in filenames]
+
+    with open(gene_names_path, "r") as file:
+        gene_names = json.load(file)
+    with open(job_logs_path, "r") as file:
+        job_logs = json.load(file)
+
+    # Gene IDs carry their chromosome number, PF3D7_0102200 being on Pf3D7_01_v3
+    chromosomes = {chromosome.split("_")[1]: chromosome for chromosome in _load_chromosomes(regions_path)}
+
+    gene_index = pd.DataFrame({
+        "gene_id":    gene_ids,
+        "filename":   filenames,
+        "gene_name":  [gene_names.get(gene_id, ".") for gene_id in gene_ids],
+        "chromosome": [chromosomes.get(gene_id[6:8]) for gene_id in gene_ids],
+    })
+    gene_index["display_name"] = [
+        f'{gene_id} - {gene_name}' if gene_name != "." else gene_id
+            for gene_id, gene_name in zip(gene_index["gene_id"], gene_index["gene_name"])
+    ]
+
+    # job_logs.json also holds a few job-level entries, which aren't genes
+    df_job_logs = pd.DataFrame.from_dict({gene_id: job_logs.get(gene_id, {}) for gene_id in gene_ids}, orient = "index")
+    df_job_logs = df_job_logs.reindex(columns = job_log_columns).astype("Int64")
+    for column in job_log_columns:
+        gene_index[column] = df_job_logs[column].values
+    return gene_index
+
+def build_gene_index(pkl_path = pkl_path, store_path = store_path, **kwargs):
+    """Writes the gene index of a release into its store, see compute_gene_index for kwargs"""
+    os.makedirs(store_path, exist_ok = True)
+    table = pa.Table.from_pandas(compute_gene_index(pkl_path, **kwargs), preserve_index = False)
+    _write_table_atomically(table, _gene_index_file(store_path), compression = "uncompressed")
+
+def load_gene_index(pkl_path = pkl_path, store_path = store_path, gene_names_path = gene_names_path,
+                    job_logs_path = job_logs_path) -> pd.DataFrame:
+    """Reads the gene index from the store if it has been built, and builds it from the original files otherwise"""
+    if not os.path.exists(_gene_index_file(store_path)):
+        return compute_gene_index(pkl_path, gene_names_path, job_logs_path)
+    return _read_table(_gene_index_file(store_path)).to_pandas()
+
+# ============================================================================================================================================================
+# Cross-gene mutation index
+#
+# precompute.compute_mutation_counts of every gene gathered into one table, with a gene_id column, so that mutations can
+# be looked up across the genome without loading any gene
+# ============================================================================================================================================================
+
+def _mutation_index_file(store_path = store_path) -> str:
+    return f"{store_path}/mutation_index.arrow"
+
+def mutation_counts_table(gene_id: str, df_mutation_counts: pd.DataFrame) -> pa.Table:
+    """
+    A gene's rows of the mutation index as an Arrow table. Arrow keeps haplotype_rows as two flat buffers, which
+    is much cheaper to send between processes than one small array per mutation
+    """
+    # Typed explicitly, so that a gene without mutations has the same schema as the others
+    table = pa.Table.from_pandas(df_mutation_counts.drop(columns = ["mutation", "haplotype_rows"]), preserve_index = False)
+    table = table.add_column(0, "mutation", pa.array(df_mutation_counts["mutation"].astype(str), pa.string()))
+    table = table.add_column(2, "haplotype_rows", pa.array(list(df_mutation_counts["haplotype_rows"]), pa.list_(pa.uint16())))
+    return table.add_column(0, "gene_id", pa.array([gene_id] * len(table), pa.string()))
+
+def write_mutation_index(gene_tables: list, store_path = store_path):
+    """Writes the mutation_counts_table of every gene as a single table"""
+    os.makedirs(store_path, exist_ok = True)
+    table = pa.concat_tables(gene_tables).combine_chunks()
+    table = table.set_column(0, "gene_id", table.column("gene_id").dictionary_encode())
+    _write_table_atomically(table, _mutation_index_file(store_path), compression = "uncompressed")
+
+def load_mutation_index(store_path = store_path):
+    """Returns the mutation index as a (memory-mapped) Arrow table, or None if it hasn't been built"""
+    path = _mutation_index_file(store_path)
+    if not os.path.exists(path):
+        return None
+    return _read_table(path)
@@ -0,0 +1,118 @@
+import collections, threading
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+def estimate_nbytes(obj) -> int:
+    """Approximate memory footprint of a cached value, counting the contents of dataframes and arrays"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep = True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep = True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(item) for item in obj.values())
+    return 64
+
+class GeneCache:
+    """
+    Thread-safe least-recently-used cache whose size is measured in bytes rather than entries. Pinned keys are never
+    evicted. A key is loaded once however many threads miss it at the same time, the others wait for that load.
+    Counters for hits, misses, waits and evictions are kept so they can be exported as metrics
+    """
+
+    def __init__(self, max_bytes: int, pinned = ()):
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.waits = 0
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        # Futures of the keys being loaded
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() to fill the cache on a miss, or waiting for the value if
+        another thread is already loading it
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            loading = self._loading.get(key)
+            waiting = loading is not None
+            if waiting:
+                self.waits += 1
+            else:
+                self.misses += 1
+                loading = self._loading[key] = concurrent.futures.Future()
+
+        if waiting:
+            return loading.result()
+
+        # Load outside the lock so that one slow gene doesn't hold up every other session
+        try:
+            value = loader()
+        except BaseException as error:
+            with self._lock:
+                del self._loading[key]
+            loading.set_exception(error)
+            raise
+
+        nbytes = estimate_nbytes(value)
+        with self._lock:
+            self._put(key, value, nbytes)
+            del self._loading[key]
+        loading.set_result(value)
+        return value
+
+    def put(self, key, value):
+        nbytes = estimate_nbytes(value)
+        with self._lock:
+            self._put(key, value, nbytes)
+
+    def _put(self, key, value, nbytes: int):
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.total_bytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                return
+            if key in self.pinned:
+                continue
+            self.total_bytes -= self._entries.pop(key)[1]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,69 @@
+"""
+Typo-tolerant search of genes by gene ID or gene name, over a trigram index built once from the gene index. Each
+gene is found under several keys, e.g. "pf3d7_1343700", "1343700" and "kelch13", which are matched by the trigrams
+they share with the query
+"""
+import collections
+import numpy as np
+
+# Proportion of the query's trigrams a gene's key must share to be returned
+min_score = 1 / 3
+
+def _trigrams(text: str, complete: bool = True) -> set:
+    """
+    Trigrams of text, padded at the start so that prefixes match, and at the end unless text is a query still being
+    typed (complete = False)
+    """
+    text = "  " + text + (" " if complete else "")
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class GeneSearch:
+    """
+    Ranks genes against a query by the proportion of the query's trigrams found in the best matching key of each
+    gene, preferring keys matched more completely, so that "kelch13" ranks Kelch13 above longer names containing it
+    """
+
+    def __init__(self, gene_ids: list, gene_names: list):
+        self.gene_ids = list(gene_ids)
+
+        keys, key_genes = [], []
+        for gene, (gene_id, gene_name) in enumerate(zip(self.gene_ids, gene_names)):
+            gene_keys = {gene_id.lower(), gene_id.split("_")[-1].lower()}
+            if gene_name != ".":
+                gene_keys.add(gene_name.lower())
+            keys.extend(gene_keys)
+            key_genes.extend([gene] * len(gene_keys))
+
+        self._keys = dict(zip(keys, key_genes))
+        self._key_genes = np.array(key_genes, dtype = np.int32)
+        self._key_trigram_counts = np.array([len(_trigrams(key)) for key in keys])
+
+        postings = collections.defaultdict(list)
+        for position, key in enumerate(keys):
+            for trigram in _trigrams(key):
+                postings[trigram].append(position)
+        self._postings = {trigram: np.array(positions, dtype = np.int32) for trigram, positions in postings.items()}
+
+    def lookup(self, query: str):
+        """The gene ID whose ID or name is exactly query, ignoring case, or None"""
+        gene = self._keys.get(query.strip().lower())
+        return None if gene is None else self.gene_ids[gene]
+
+    def search(self, query: str, k: int = 20) -> list:
+        """The IDs of the (at most) k genes best matching query, best first"""
+        query_trigrams = _trigrams(query.strip().lower(), complete = False)
+        matched = [self._postings[trigram] for trigram in query_trigrams if trigram in self._postings]
+        if not query.strip() or not matched:
+            return []
+
+        shared = np.bincount(np.concatenate(matched), minlength = len(self._key_genes))
+        key_scores = shared / len(query_trigrams) + 0.1 * shared / self._key_trigram_counts
+
+        gene_scores = np.zeros(len(self.gene_ids))
+        np.maximum.at(gene_scores, self._key_genes, key_scores)
+
+        # Genes sharing less than a third of the query's trigrams aren't plausible matches, even with typos. Ties are
+        # broken by gene order, which keeps results stable between reruns
+        candidates = np.flatnonzero(gene_scores >= min_score)
+        best = candidates[np.lexsort((candidates, -gene_scores[candidates]))[:k]]
+        return [self.gene_ids[gene] for gene in best]
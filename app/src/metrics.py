@@ -0,0 +1,56 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Callables returning a flat {name: number} dict, keyed by the prefix their metrics are exported under
+_collectors = {}
+
+# Set once the process has loaded what users need (see caches.warm_up_caches), reported at /ready
+_ready = threading.Event()
+
+def set_ready():
+    _ready.set()
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+def register_collector(prefix: str, collector):
+    _collectors[prefix] = collector
+
+def render_metrics() -> str:
+    """Renders every registered collector in the Prometheus text exposition format"""
+    lines = []
+    for prefix, collector in _collectors.items():
+        for name, value in collector().items():
+            lines.append(f"haploatlas_{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(200, render_metrics(), "text/plain; version=0.0.4")
+        elif self.path == "/ready":
+            # For orchestrators to poll, so that users are only routed to processes which have warmed up
+            if is_ready():
+                self._send(200, "ready\n", "text/plain")
+            else:
+                self._send(503, "warming up\n", "text/plain")
+        else:
+            self.send_error(404)
+
+    def _send(self, status: int, text: str, content_type: str):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serves /metrics and /ready on a daemon thread, next to (not through) the Streamlit server"""
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
@@ -0,0 +1,297 @@
+"""
+Per-gene aggregates that only depend on the gene's data, not on user settings. They are built once per gene,
+either offline by app/build_store.py or on first use in the app, so that user interactions only slice them
+"""
+import numpy as np
+import pandas as pd
+
+from src.aggregations import group_codes, count_by_group
+
+def _relabel_reference(ns_changes: pd.Series) -> pd.Series:
+    return ns_changes.replace({"": "3D7 REF"})
+
+# ============================================================================================================================================================
+# Haplotype UpSet plot
+# ============================================================================================================================================================
+
+def compute_haplotype_totals(df_haplotypes: pd.DataFrame) -> dict:
+    """
+    The Total of every haplotype in the stored order, which is by decreasing Total, and its running sum starting at 0.
+    The haplotypes with at least min_samples samples are then a prefix of df_haplotypes, see count_haplotypes_shown
+    """
+    totals = df_haplotypes['Total'].values.astype(int)
+    if ( np.diff(totals) > 0 ).any():
+        raise ValueError("Haplotypes are not sorted by decreasing Total")
+
+    cum_totals = np.zeros(len(totals) + 1, dtype = int)
+    cum_totals[1:] = np.cumsum(totals)
+    return {
+        "totals":     totals,
+        "cum_totals": cum_totals,
+    }
+
+def count_haplotypes_shown(totals: dict, min_samples: int) -> int:
+    """Number of leading haplotypes with at least min_samples samples, by binary search"""
+    # searchsorted needs increasing values
+    return len(totals["totals"]) - int(np.searchsorted(totals["totals"][::-1], min_samples, side = "left"))
+
+def compute_mutation_index(df_haplotypes: pd.DataFrame) -> dict:
+    """
+    Every mutation found in the gene's haplotypes, sorted by name, with its amino acid position and the largest Total
+    of the haplotypes it is found in. The mutations of the haplotypes shown for a given min_samples are then the ones
+    with max_total >= min_samples. Haplotypes without samples are left out, as min_samples is at least 1. Returns a
+    dictionary of arrays: mutations, aa and max_total
+    """
+    df = df_haplotypes.loc[df_haplotypes['Total'] > 0, ['ns_changes_list', 'Total']].explode('ns_changes_list')
+    max_total = df.loc[df['ns_changes_list'] != ''].groupby('ns_changes_list')['Total'].max()
+    mutations = max_total.index.values.astype(str)
+
+    return {
+        "mutations": mutations,
+        "aa":        np.array([int(mutation[1:-1]) for mutation in mutations], dtype = int),
+        "max_total": max_total.values.astype(int),
+    }
+
+def slice_mutation_index(index: dict, min_samples: int) -> pd.DataFrame:
+    """The mutations shown in the UpSet plot, sorted by amino acid position, with their row in the plot as 'index'"""
+    return _mutation_rows(index, index["max_total"] >= min_samples)
+
+def slice_mutation_index_for_haplotypes(index: dict, ns_changes_lists) -> pd.DataFrame:
+    """As slice_mutation_index, for the mutations of some of the haplotypes shown, given their ns_changes_list"""
+    return _mutation_rows(index, np.isin(index["mutations"], np.concatenate(list(ns_changes_lists))))
+
+def _mutation_rows(index: dict, shown: np.ndarray) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            'mutation': index["mutations"][shown],
+            'aa': index["aa"][shown],
+        }
+    ).sort_values('aa').reset_index(drop=True).reset_index().set_index('mutation')
+
+# ============================================================================================================================================================
+# Abacus plot
+# ============================================================================================================================================================
+
+def compute_abacus_cube(df_join: pd.DataFrame, df_haplotypes: pd.DataFrame) -> dict:
+    """
+    Counts the samples of every haplotype in every (location, year) cell, where a location is a
+    (Population, Country, Admin level 1) triple. Returns a dictionary of arrays:
+
+    - locations: the sorted location triples, as three string arrays, with location_totals samples each
+    - cell_location, cell_year: the (location, year) cells with any samples, sorted by location then year
+    - cell_n: number of homozygous samples per cell, the denominator of the haplotype frequency
+    - counts: haplotype x cell sample counts, for every haplotype in df_haplotypes
+    """
+    df = df_join.loc[df_join['Exclusion reason'] == 'Analysis_set', ['Population', 'Country display name', 'Admin level 1', 'Year', 'ns_changes']]
+    df = df.rename(columns = {'Country display name': 'Country'})
+
+    ns_changes = _relabel_reference(df['ns_changes'])
+    homozygous = ( ns_changes == ns_changes.str.upper() ).values
+
+    location_codes, locations = group_codes(df, ['Population', 'Country', 'Admin level 1'])
+    location_totals = count_by_group(location_codes, len(locations))
+
+    # Samples without a year count towards their location's total but not towards any cell
+    has_year = df['Year'].notna().values & ( location_codes >= 0 )
+    year_codes, years = pd.factorize(df['Year'].values[has_year], sort = True)
+    cell_ids, cell_codes = np.unique(location_codes[has_year] * len(years) + year_codes, return_inverse = True)
+
+    haplotype_codes = pd.Index(_relabel_reference(df_haplotypes['ns_changes'])).get_indexer(ns_changes.values[has_year])
+    known = haplotype_codes >= 0
+    counts = np.zeros((len(df_haplotypes), len(cell_ids)), dtype = np.uint16)
+    np.add.at(counts, (haplotype_codes[known], cell_codes[known]), 1)
+
+    return {
+        "haplotypes":          _relabel_reference(df_haplotypes['ns_changes']).values.astype(str),
+        "location_population": locations['Population'].values.astype(str),
+        "location_country":    locations['Country'].values.astype(str),
+        "location_admin":      locations['Admin level 1'].values.astype(str),
+        "location_totals":     location_totals,
+        "cell_location":       cell_ids // len(years),
+        "cell_year":           np.asarray(years, dtype = int)[cell_ids % len(years)],
+        "cell_n":              count_by_group(cell_codes, len(cell_ids), homozygous[has_year]),
+        "counts":              counts,
+    }
+
+def slice_abacus_cube(cube: dict, ns_changes: str, min_samples: int) -> pd.DataFrame:
+    """
+    Haplotype frequencies per location and year for one haplotype, keeping locations with at least min_samples
+    samples overall and years with at least min_samples homozygous samples
+    """
+    cell_location = cube["cell_location"]
+    keep = ( cube["location_totals"][cell_location] >= min_samples ) & ( cube["cell_n"] >= min_samples )
+
+    haplotype_index = np.flatnonzero(cube["haplotypes"] == ns_changes)
+    if len(haplotype_index) == 0:
+        counts = np.zeros(keep.sum())
+    else:
+        counts = cube["counts"][haplotype_index[0], keep]
+
+    locations = cell_location[keep]
+    n = cube["cell_n"][keep].astype(float)
+
+    return pd.DataFrame({
+        'Population':                cube["location_population"][locations],
+        'Country':                   cube["location_country"][locations],
+        'Admin level 1':             cube["location_admin"][locations],
+        'Year':                      cube["cell_year"][keep],
+        'n':                         n,
+        f'{ns_changes} frequency':   counts / n,
+    })
+
+# ============================================================================================================================================================
+# World map plot
+# ============================================================================================================================================================
+
+def _worldmap_samples(df_join: pd.DataFrame) -> pd.DataFrame:
+    """
+    QC pass analysis set samples relabelled for country-level aggregation on the world map: countries by their display
+    name, coloured by their majority population
+    """
+    df = df_join.loc[( df_join['Exclusion reason'] == 'Analysis_set' ) & df_join['QC pass'],
+                     ['iso_alpha', 'Country display name', 'Country majority population', 'Year', 'ns_changes']]
+    df = df.rename(columns = {'Country display name': 'Country', 'Country majority population': 'Population'})
+
+    # deal with encoding of 'wildtype' in literature dataset
+    df['ns_changes'] = df['ns_changes'].replace({'wildtype': ''})
+    df['ns_changes'] = _relabel_reference(df['ns_changes'])
+    return df
+
+def compute_worldmap_index(df_join: pd.DataFrame, df_haplotypes: pd.DataFrame) -> dict:
+    """
+    Cumulative sample counts per country over the years, so that counts for any year range are the difference
+    of two columns. A country here is an (iso_alpha, Country, Population) triple. Returns a dictionary of arrays:
+
+    - country_iso_alpha, country_name, country_population: the sorted country triples
+    - years: the sorted years with any samples
+    - total_cum, n_cum: country x (years + 1) cumulative counts of all and of homozygous samples, starting at 0
+    - counts_cum: haplotype x country x (years + 1) cumulative counts, for every haplotype in df_haplotypes
+    """
+    df = _worldmap_samples(df_join)
+    df = df.loc[df['Year'].notna()]
+    homozygous = ( df['ns_changes'] == df['ns_changes'].str.upper() ).values
+
+    country_codes, countries = group_codes(df, ['iso_alpha', 'Country', 'Population'])
+    year_codes, years = pd.factorize(df['Year'].values, sort = True)
+
+    cells = country_codes * len(years) + year_codes
+    known = country_codes >= 0
+    n_cells = len(countries) * len(years)
+
+    def _cumulative(cell_counts, shape):
+        cumulative = np.zeros(shape[:-1] + (shape[-1] + 1,), dtype = np.uint16)
+        cumulative[..., 1:] = np.cumsum(cell_counts.reshape(shape), axis = -1)
+        return cumulative
+
+    haplotype_codes = pd.Index(_relabel_reference(df_haplotypes['ns_changes'])).get_indexer(df['ns_changes'].values)
+    haplotype_known = known & ( haplotype_codes >= 0 )
+    counts = np.zeros((len(df_haplotypes), n_cells), dtype = np.uint16)
+    np.add.at(counts, (haplotype_codes[haplotype_known], cells[haplotype_known]), 1)
+
+    return {
+        "haplotypes":         _relabel_reference(df_haplotypes['ns_changes']).values.astype(str),
+        "country_iso_alpha":  countries['iso_alpha'].values.astype(str),
+        "country_name":       countries['Country'].values.astype(str),
+        "country_population": countries['Population'].values.astype(str),
+        "years":              np.asarray(years, dtype = int),
+        "total_cum":          _cumulative(count_by_group(cells, n_cells, known), (len(countries), len(years))),
+        "n_cum":              _cumulative(count_by_group(cells, n_cells, known & homozygous), (len(countries), len(years))),
+        "counts_cum":         _cumulative(counts, (len(df_haplotypes), len(countries), len(years))),
+    }
+
+def slice_worldmap_index(index: dict, ns_changes: str, year: tuple) -> pd.DataFrame:
+    """Per country counts and frequency of one haplotype between two years (inclusive), for countries with any samples in that range"""
+    start = np.searchsorted(index["years"], year[0], side = "left")
+    stop = np.searchsorted(index["years"], year[1], side = "right")
+
+    total = index["total_cum"][:, stop].astype(int) - index["total_cum"][:, start]
+    present = total > 0
+
+    n = index["n_cum"][present, stop].astype(int) - index["n_cum"][present, start]
+    haplotype_index = np.flatnonzero(index["haplotypes"] == ns_changes)
+    if len(haplotype_index) == 0:
+        haplo_count = np.zeros(len(n), dtype = int)
+    else:
+        counts_cum = index["counts_cum"][haplotype_index[0]]
+        haplo_count = counts_cum[present, stop].astype(int) - counts_cum[present, start]
+
+    return pd.DataFrame({
+        'iso_alpha':     index["country_iso_alpha"][present],
+        'Country':       index["country_name"][present],
+        'Year-interval': str(year),
+        'Population':    index["country_population"][present],
+        'n':             n,
+        'haplo_count':   haplo_count,
+        'frequency':     haplo_count / np.where(n > 0, n, np.nan),
+    })
+
+# ============================================================================================================================================================
+# Cross-gene mutation index, the rows of every gene are gathered into one table by app/build_store.py
+# ============================================================================================================================================================
+
+# Columns of df_haplotypes which aren't sample counts per population
+_haplotype_columns = ["number_of_mutations", "ns_changes", "Total", "ns_changes_list", "sample_names", "cum_proportion"]
+
+def compute_mutation_counts(df_haplotypes: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per mutation of the gene, with the positions in df_haplotypes of the haplotypes carrying it
+    (haplotype_rows) and, for every population, the number of samples carrying it and the number of samples of the
+    gene in that population ("<population> n"), the denominator of its frequency
+    """
+    populations = [column for column in df_haplotypes.columns if column not in _haplotype_columns]
+    df = df_haplotypes[['ns_changes_list', *populations]].assign(haplotype_row = np.arange(len(df_haplotypes)))
+    df = df.loc[df_haplotypes['Total'].values > 0].explode('ns_changes_list')
+    df = df.loc[df['ns_changes_list'] != ''].rename(columns = {'ns_changes_list': 'mutation'})
+
+    # Each mutation's rows are contiguous once sorted, so counts are sums over slices rather than a groupby
+    df = df.sort_values('mutation', kind = 'stable')
+    mutations, starts = np.unique(df['mutation'].values.astype(str), return_index = True)
+
+    df_counts = pd.DataFrame({
+        'mutation':       mutations,
+        'aa':             pd.to_numeric(pd.Series(mutations).str[1:-1], errors = 'coerce').astype('Int32'),
+        'haplotype_rows': np.split(df['haplotype_row'].values.astype(np.uint16), starts[1:]) if len(df) else [],
+    })
+    if len(df):
+        df_counts[populations] = np.add.reduceat(df[populations].values.astype(int), starts, axis = 0).astype(np.uint16)
+    else:
+        df_counts[populations] = np.zeros((0, len(populations)), dtype = np.uint16)
+
+    totals = df_haplotypes[populations].values.astype(int).sum(axis = 0)
+    for population, total in zip(populations, totals):
+        df_counts[f'{population} n'] = np.full(len(df_counts), total, dtype = np.uint16)
+    return df_counts
+
+def slice_mutation_counts(df_counts: pd.DataFrame, population: str, min_frequency: float, min_n: int = 1) -> pd.DataFrame:
+    """
+    The mutations of any gene carried by more than min_frequency (a proportion) of the samples of population, for genes
+    with at least min_n samples in that population, by decreasing frequency. Indexed by their row in df_counts
+    """
+    count = df_counts[population].values
+    n = df_counts[f'{population} n'].values.astype(int)
+    frequency = count / np.where(n > 0, n, np.nan)
+
+    keep = ( n >= max(min_n, 1) ) & ( frequency > min_frequency )
+    df = df_counts.loc[keep, ['gene_id', 'mutation', 'aa']].assign(count = count[keep], n = n[keep], frequency = frequency[keep])
+    return df.sort_values(['frequency', 'gene_id'], ascending = [False, True], kind = 'stable')
+
+# ============================================================================================================================================================
+# Every artifact above, by the name it is stored under (see data_store.write_gene_artifact). Each is built from the
+# gene's df_join and df_haplotypes
+# ============================================================================================================================================================
+
+artifact_builders = {
+    "totals":    lambda df_join, df_haplotypes: compute_haplotype_totals(df_haplotypes),
+    "mutations": lambda df_join, df_haplotypes: compute_mutation_index(df_haplotypes),
+    "abacus":    compute_abacus_cube,
+    "worldmap":  compute_worldmap_index,
+}
+
+# The version of each artifact's builder, stored with the artifact. Bump it whenever the builder's output changes, so
+# that artifacts built before are treated as missing, recomputed by the app and rebuilt by app/build_store.py
+artifact_versions = {
+    "totals":    1,
+    "mutations": 1,
+    "abacus":    1,
+    "worldmap":  1,
+}
@@ -0,0 +1,71 @@
+"""
+Loads the genes a user is likely to look at next into the gene cache in the background, while they look at the plots
+of the current gene, so that picking one of them doesn't wait for a cold load
+"""
+import threading
+import concurrent.futures
+
+class Prefetcher:
+    """
+    Runs prefetch jobs on max_workers background threads. Each owner, e.g. a session, has at most one batch of jobs
+    at a time: a new batch, or cancel(), cancels the jobs of the previous batch which haven't started yet. A job is
+    skipped when its key is already cached, or when the gene cache holds budget_bytes or more, so that prefetched
+    genes never push out the genes users actually opened
+    """
+
+    def __init__(self, gene_cache, budget_bytes: int, max_workers: int = 1):
+        self.gene_cache = gene_cache
+        self.budget_bytes = budget_bytes
+        self.loaded = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self._batches = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "gene-prefetch")
+        self._lock = threading.Lock()
+
+    def prefetch(self, owner, jobs: dict):
+        """
+        Runs jobs, which map gene cache keys to functions loading them into the gene cache, in order, cancelling
+        owner's previous batch
+        """
+        cancelled = threading.Event()
+        with self._lock:
+            self._cancel(owner)
+            # Batches of owners which are gone, e.g. closed sessions, are dropped once they're done
+            self._batches = {
+                other: batch for other, batch in self._batches.items() if not all(future.done() for future in batch[1])
+            }
+            futures = [self._executor.submit(self._run, key, load, cancelled) for key, load in jobs.items()]
+            self._batches[owner] = (cancelled, futures)
+
+    def cancel(self, owner):
+        with self._lock:
+            self._cancel(owner)
+
+    def _cancel(self, owner):
+        if owner not in self._batches:
+            return
+        cancelled, futures = self._batches.pop(owner)
+        # A job already taken by a worker can't be cancelled through its future, the event stops it before it loads
+        cancelled.set()
+        self.cancelled += sum(future.cancel() for future in futures)
+
+    def _run(self, key, load, cancelled: threading.Event):
+        if cancelled.is_set():
+            self.cancelled += 1
+            return
+        if key in self.gene_cache or self.gene_cache.total_bytes >= self.budget_bytes:
+            self.skipped += 1
+            return
+        load()
+        self.loaded += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = sum(not future.done() for _, futures in self._batches.values() for future in futures)
+        return {
+            "loaded": self.loaded,
+            "skipped": self.skipped,
+            "cancelled": self.cancelled,
+            "pending": pending,
+        }
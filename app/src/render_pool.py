@@ -0,0 +1,107 @@
+"""
+Long-lived pool of worker processes rendering plotly figures to static images with Kaleido. Each worker keeps its
+own Kaleido (Chromium) subprocess alive between jobs, so the number of Chromium processes on a host is capped at the
+number of workers, however many sessions are exporting figures at once
+"""
+import multiprocessing, threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+class RenderError(Exception):
+    """Raised when a figure could not be rendered, because the pool is busy, the job timed out or the renderer crashed"""
+
+def _render(figure_json: str, format: str, height: int, width: int) -> bytes:
+    """Runs in a worker process"""
+    import plotly.io as pio
+    return pio.to_image(pio.from_json(figure_json), format = format, height = height, width = width)
+
+class RenderPool:
+    """
+    Renders figure JSON to bytes in max_workers processes. At most max_queue jobs wait for a free worker, beyond which
+    jobs are rejected straight away rather than piling up. A job that runs for longer than timeout seconds is assumed
+    to be stuck, and the workers are restarted
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 8, timeout: float = 60):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.rendered = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        # Jobs wait here rather than in the executor's queue, so that a job is only submitted once a worker is free
+        # and its timeout doesn't count the time spent behind other jobs
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Not forked, the Streamlit server process is full of threads
+                self._executor = concurrent.futures.ProcessPoolExecutor(self.max_workers, mp_context = multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _restart(self, executor: concurrent.futures.ProcessPoolExecutor):
+        """Kills the workers of executor, the next job starts a fresh pool. Does nothing if it has already been replaced"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.restarts += 1
+
+        # ProcessPoolExecutor can't cancel a running job, so stuck workers are terminated directly
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    def _count(self, counter: str):
+        # The counters are read by the metrics thread
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def render(self, figure_json: str, format: str, height: int, width: int) -> bytes:
+        if not self._slots.acquire(blocking = False):
+            self._count("rejected")
+            raise RenderError("Too many figures are being rendered, please try again in a moment")
+
+        try:
+            # A restart kills the other jobs running in the pool, and a crashed worker breaks the whole pool, so a job
+            # caught up in someone else's timeout or crash is retried once
+            for attempt in range(2):
+                with self._workers:
+                    executor = self._get_executor()
+                    try:
+                        image = executor.submit(_render, figure_json, format, height, width).result(timeout = self.timeout)
+                    except concurrent.futures.TimeoutError:
+                        self._count("timeouts")
+                        self._restart(executor)
+                        raise RenderError(f"Rendering the figure took longer than {self.timeout:.0f} s")
+                    except (BrokenProcessPool, concurrent.futures.CancelledError):
+                        self._restart(executor)
+                        if attempt == 1:
+                            raise RenderError("The figure renderer crashed")
+                        continue
+                    except Exception as error:
+                        raise RenderError(f"The figure could not be rendered: {error}") from error
+                self._count("rendered")
+                return image
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "rendered": self.rendered,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "restarts": self.restarts,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
@@ -0,0 +1,98 @@
+"""
+Cache of derived data files shared by every app process on a host, e.g. the replicas behind a load balancer, so that
+a gene's lzma-pickle file is decoded, or an artifact computed, once per host rather than once per process. Entries
+are Arrow/numpy files written by data_store, which processes read (or memory-map) from the same place
+"""
+import hashlib, os, shutil, uuid
+
+class SharedCache:
+    """No shared cache: every process builds what it needs itself, see DiskCache"""
+
+    def path(self, namespace: str, sources: list, build):
+        """
+        The directory holding the entry derived from the source files under namespace, calling build(directory) to
+        write it first if no process has. None when there is no shared cache, callers then build in memory instead
+        """
+        return None
+
+    def stats(self) -> dict:
+        return {}
+
+class DiskCache(SharedCache):
+    """
+    Content-addressed entries under directory: an entry is named after a digest of its namespace and of the path, size
+    and modification time of its sources, so that it is rebuilt under a new name whenever a source changes. Entries
+    are written to a temporary directory and renamed into place, and a lock file makes other processes wait for the
+    entry rather than build it again. Stale entries are never read, and the directory can be emptied at any time
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hits = 0
+        self.builds = 0
+        self.failures = 0
+
+    def _entry_path(self, namespace: str, sources: list) -> str:
+        digest = hashlib.sha256(namespace.encode())
+        for source in sources:
+            status = os.stat(source)
+            digest.update(f"\0{os.path.realpath(source)}\0{status.st_size}\0{status.st_mtime_ns}".encode())
+        return os.path.join(self.directory, namespace, digest.hexdigest())
+
+    def path(self, namespace: str, sources: list, build):
+        path = self._entry_path(namespace, sources)
+        if os.path.isdir(path):
+            self.hits += 1
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # Locked per entry, flock also keeps apart threads of one process as each opens the lock file itself
+        with _FileLock(f"{path}.lock"):
+            # Another process may have built it while this one waited for the lock
+            if os.path.isdir(path):
+                self.hits += 1
+                return path
+
+            tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+            try:
+                os.makedirs(tmp_path)
+                build(tmp_path)
+                os.rename(tmp_path, path)
+            except Exception:
+                self.failures += 1
+                shutil.rmtree(tmp_path, ignore_errors = True)
+                raise
+            self.builds += 1
+            return path
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "builds": self.builds,
+            "failures": self.failures,
+        }
+
+class _FileLock:
+    """Exclusive lock across processes on path, created if missing. Does nothing where fcntl isn't available"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            self._file.close() # releases the lock
+            self._file = None
+
+def open_shared_cache(location) -> SharedCache:
+    """The shared cache at location, a directory, or no shared cache when location is empty"""
+    return DiskCache(location) if location else SharedCache()
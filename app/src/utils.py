@@ -1,53 +1,153 @@
 import streamlit as st
-import json, os, lzma, pickle, collections, io
-import pandas as pd
+import json, os, collections, functools, uuid
+import concurrent.futures
+import plotly.graph_objects as go
 
-base_path = "app/files/2024-06-24_pkl_files"
+from src import caches, metrics, render_pool
+from src.caches import priority_gene_ids
+from src.gene_cache import GeneCache
+from src.prefetcher import Prefetcher
+
+# The process-level caches behind these wrappers are in caches, which never runs Streamlit commands so that
+# background threads and app/serve.py can fill them
 
 @st.cache_data
-def _cache_load_utility_mappers(base_path = base_path):
+def _cache_load_releases():
+    """The data releases the app serves, the first being the default (see data_store.load_releases)"""
+    return caches.load_releases()
+
+def selected_release() -> str:
+    """The ID of the data release chosen in this session, the default release until one is chosen"""
+    releases = _cache_load_releases()
+    release_id = st.session_state.get("release")
+    return release_id if release_id in releases else next(iter(releases))
+
+@st.cache_data
+def _cache_load_release_mappers(release_id: str):
+    """The gene ID and name mappings of a release, see caches.load_release_mappers. Each session gets its own copy"""
+    return caches.load_release_mappers(release_id)
+
+def _cache_load_utility_mappers():
+    """The gene ID and name mappings of the release selected in this session, see _cache_load_release_mappers"""
+    return _cache_load_release_mappers(selected_release())
+
+@st.cache_resource
+def _cache_load_gene_search(release_id: str):
+    """The gene search index of a release, see caches.load_gene_search"""
+    return caches.load_gene_search(release_id)
+
+def cache_load_gene_job_logs(gene_id: str) -> dict:
+    """The job log sample counts of a gene of the selected release, see caches.load_job_logs"""
+    return caches.load_job_logs(selected_release()).get(gene_id, {})
+
+@st.cache_resource
+def _cache_load_release_metadata(release_id: str):
     """
-    Loads various useful dictionaries and lists related to handling gene IDs and converting
-    back and forth between gene IDs and gene names etc. 
-    Caches the objects when first loaded
+    The typed sample metadata of a release (see caches.load_release_metadata), shared by every session, so callers
+    must not modify it in place
     """
-    
-    with open("app/files/core_genes.json", "r") as f:
-            gene_mapper = json.load(f)
-    
-    files_to_gene_ids = {f: f.split(".")[0] for f in os.listdir(base_path) if f.endswith("pkl.xz")}
-    
-    gene_ids_to_files = dict( zip(files_to_gene_ids.values(), files_to_gene_ids.keys()) )
-    
-    gene_ids_to_gene_names = {
-        gene: (f'{gene} - {gene_mapper[gene]}' if gene_mapper[gene] != "." else gene)
-            for gene in sorted(files_to_gene_ids.values())
-    }
-    
-    gene_names_to_gene_ids = dict(zip(gene_ids_to_gene_names.values(), gene_ids_to_gene_names.keys()))
-    
-    gene_ids = [gene_id for gene_id, gene_name in gene_ids_to_gene_names.items()] # before core genes identified: if _is_core_genome(gene_name)
-    
-    return {
-        "gene_ids_to_files": gene_ids_to_files,
-        "gene_ids_to_gene_names": gene_ids_to_gene_names,
-        "gene_names_to_gene_ids": gene_names_to_gene_ids,
-        "gene_ids": gene_ids
+    return caches.load_release_metadata(release_id)
+
+@st.cache_resource
+def _cache_load_mutation_index(release_id: str):
+    """The cross-gene mutation index of a release or None, see caches.load_mutation_index"""
+    return caches.load_mutation_index(release_id)
+
+@st.cache_resource
+def _cache_prefetcher():
+    """
+    Process-wide prefetcher of the genes users are likely to pick next (see prefetcher.Prefetcher), which only loads
+    genes while the gene cache holds less than HAPLOATLAS_PREFETCH_MB
+    """
+    prefetcher = Prefetcher(caches.get_gene_cache(), budget_bytes = int(os.environ.get("HAPLOATLAS_PREFETCH_MB", 256)) * 2**20)
+    metrics.register_collector("prefetch", prefetcher.stats)
+    return prefetcher
+
+@st.cache_resource
+def _cache_start_metrics_server():
+    """Starts the /metrics endpoint once per process if HAPLOATLAS_METRICS_PORT is set, see caches.start_metrics_server"""
+    caches.start_metrics_server()
+
+@st.cache_resource
+def _cache_start_warm_up():
+    """
+    Starts warming up the caches once per process if app/serve.py hasn't already, see caches.start_warm_up. The
+    warm-up runs on its own thread, outside of this session's script run
+    """
+    caches.start_warm_up()
+
+def _likely_next_gene_ids(gene_id: str, release_id: str) -> list:
+    """
+    The genes most often picked after gene_id: its neighbours on the chromosome, HAPLOATLAS_PREFETCH_NEIGHBOURS on
+    each side (default 2), nearest first, then the priority genes
+    """
+    gene_index = caches.load_gene_index(release_id)
+    gene_ids, chromosomes = list(gene_index["gene_id"]), list(gene_index["chromosome"])
+    position = gene_ids.index(gene_id)
+
+    neighbours = []
+    for distance in range(1, int(os.environ.get("HAPLOATLAS_PREFETCH_NEIGHBOURS", 2)) + 1):
+        for neighbour in (position - distance, position + distance):
+            # The gene index is sorted by gene ID, so genes next to each other on a chromosome are next to each other
+            if 0 <= neighbour < len(gene_ids) and chromosomes[neighbour] == chromosomes[position]:
+                neighbours.append(gene_ids[neighbour])
+
+    return [other for other in dict.fromkeys(neighbours + priority_gene_ids) if other != gene_id and other in gene_ids]
+
+def prefetch_likely_genes(gene_id: str):
+    """
+    Starts loading the genes likely to be picked after gene_id (see _likely_next_gene_ids) into the gene cache in the
+    background, replacing what this session was prefetching before
+    """
+    release_id = selected_release()
+    gene_ids_to_files = caches.load_release_mappers(release_id)["gene_ids_to_files"]
+    load_gene_data = caches.gene_data_loader(release_id)
+
+    jobs = {
+        (release_id, other): functools.partial(load_gene_data, gene_ids_to_files[other])
+            for other in _likely_next_gene_ids(gene_id, release_id)
     }
+    _cache_prefetcher().prefetch(_prefetch_owner(), jobs)
 
-@st.cache_data
-def _cache_load_pf7_metadata():
-    pf7_metadata = pd.read_excel('app/files/Pf7_metadata.xlsx').drop('Exclusion reason', axis=1).reset_index()
-    return pf7_metadata
+def cancel_gene_prefetch():
+    """Stops prefetching for this session, e.g. when another gene is picked, so that it doesn't slow down loading it"""
+    _cache_prefetcher().cancel(_prefetch_owner())
 
-@st.cache_data
-def cache_load_gene_summary(filename: str, base_path = base_path):
-    """Loads the relevant gene summary file based on provided file path. Caches the objects when first loaded"""    
-    with lzma.open(f'{base_path}/{filename}', 'rb') as file:
-        loaded_plot_data = pickle.load(file)
-    df_haplotypes, df_join, background_ns_changes, _ = loaded_plot_data
-    df_join = pd.concat([df_join.reset_index(), _cache_load_pf7_metadata()], axis=1)
-    return df_haplotypes, df_join, background_ns_changes
+def _prefetch_owner() -> str:
+    """Identifies this session's prefetch jobs"""
+    return st.session_state.setdefault("prefetch_owner", uuid.uuid4().hex)
+
+@st.cache_resource
+def _cache_loader_pool():
+    """
+    Process-wide pool of threads loading several genes at once, sized through the HAPLOATLAS_LOADER_THREADS
+    environment variable. Threads rather than processes, as loaded genes go into the shared gene cache
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers = int(os.environ.get("HAPLOATLAS_LOADER_THREADS", 4)),
+                                                 thread_name_prefix = "gene-loader")
+
+def cache_load_gene_summaries(filenames: list, release_id = None) -> list:
+    """
+    Loads several gene summaries concurrently, from the release selected in this session unless release_id is
+    given. Returns the (df_haplotypes, codes, dictionary, background_ns_changes) of each gene in the order of
+    filenames, see data_store.load_gene_summary
+    """
+    return list(_cache_loader_pool().map(caches.gene_data_loader(release_id or selected_release()), filenames))
+
+def cache_load_gene_summary(filename: str, release_id = None):
+    """
+    Loads the relevant gene summary joined onto the shared sample metadata (see caches.load_gene_summary), from the
+    release selected in this session unless release_id is given. df_haplotypes is the cached dataframe shared
+    between sessions, so callers must not modify it in place
+    """
+    return caches.load_gene_summary(filename, release_id or selected_release())
+
+def cache_load_gene_artifact(gene_id: str, name: str, release_id = None):
+    """
+    Loads one of the gene's precomputed artifacts (see caches.load_gene_artifact), from the release selected in this
+    session unless release_id is given
+    """
+    return caches.load_gene_artifact(gene_id, name, release_id or selected_release())
 
 @st.cache_data
 def cache_load_population_colours():
@@ -70,34 +170,101 @@ def _cache_load_changelog():
     with open("app/files/changelog.md", "r") as f:
         return f.read()
 
-def generate_download_buttons(fig, gene_id_selected, height, width, plot_number):
-    """Generates download buttons for different image formats (PDF, PNG, SVG) for a given plot."""
+# Names of the plots by their number, as shown in the app
+plot_names = {
+    1: "haplotype_upset_plot",
+    2: "abacus_plot",
+    3: "worldmap_plot",
+    4: "multigene_plot"
+}
 
-    plot_name_dictionary = {
-        1: "haplotype_upset_plot",
-        2: "abacus_plot",
-        3: "worldmap_plot"
-    }
+@st.cache_resource
+def _cache_figure_cache():
+    """
+    Process-wide cache of built figures, stored as plotly JSON, so that reruns which don't change a plot's inputs
+    skip rebuilding it. Bounded in MB through the HAPLOATLAS_FIGURE_CACHE_MB environment variable
+    """
+    figure_cache = GeneCache(max_bytes = int(os.environ.get("HAPLOATLAS_FIGURE_CACHE_MB", 64)) * 2**20)
+    metrics.register_collector("figure_cache", figure_cache.stats)
+    return figure_cache
 
-    plot_name = plot_name_dictionary[plot_number]
+def cache_build_figure(gene_id_selected, plot_number, figure_key, build):
+    """
+    Returns the figure made by build(), reusing the figure of an earlier run with the same release, gene, plot and
+    figure_key. figure_key must hold every user setting the figure depends on (haplotype, year range, min_samples, ...)
+    """
+    built = []
+    def _build_figure_json():
+        built.append(build())
+        return built[0].to_json()
 
-    # Create in-memory buffers to download the plot
-    buffers = {}
-    formats = ["pdf", "png", "svg"]
-    for format in formats:
-        buffer = io.BytesIO()
-        fig.write_image(file=buffer, format=format, height=height, width=width)
-        buffers[format] = buffer
+    figure_json = _cache_figure_cache().get((selected_release(), gene_id_selected, plot_names[plot_number], *figure_key), _build_figure_json)
+    if built:
+        return built[0]
+
+    # The cached JSON was produced by plotly in the first place, so validating it again would only cost time
+    return go.Figure(json.loads(figure_json), _validate = False)
+
+@st.cache_resource
+def _cache_export_cache():
+    """
+    Process-wide cache of rendered figure exports, so that a figure is only rendered once per format however many
+    sessions download it. Bounded in MB through the HAPLOATLAS_EXPORT_CACHE_MB environment variable
+    """
+    export_cache = GeneCache(max_bytes = int(os.environ.get("HAPLOATLAS_EXPORT_CACHE_MB", 64)) * 2**20)
+    metrics.register_collector("export_cache", export_cache.stats)
+    return export_cache
+
+@st.cache_resource
+def _cache_render_pool():
+    """
+    Process-wide pool of Kaleido renderers shared by every session, sized through the HAPLOATLAS_RENDER_WORKERS
+    environment variable. Jobs time out after HAPLOATLAS_RENDER_TIMEOUT seconds
+    """
+    pool = render_pool.RenderPool(
+        max_workers = int(os.environ.get("HAPLOATLAS_RENDER_WORKERS", 2)),
+        timeout     = float(os.environ.get("HAPLOATLAS_RENDER_TIMEOUT", 60))
+    )
+    metrics.register_collector("render_pool", pool.stats)
+    return pool
+
+def _render_figure(fig, format, height, width) -> bytes:
+    return _cache_render_pool().render(fig.to_json(), format, height, width)
+
+def generate_download_buttons(fig, gene_id_selected, height, width, plot_number, export_key = ()):
+    """
+    Generates download buttons for different image formats (PDF, PNG, SVG) for a given plot. Figures are only
+    rendered when a format is requested, after which they are kept in the export cache under the release, gene, plot
+    and export_key, which must hold every user setting the figure depends on (haplotype, year range, min_samples, ...)
+    """
 
+    plot_name = plot_names[plot_number]
     figure_name = f"{gene_id_selected}_{plot_name}"
+    export_cache = _cache_export_cache()
 
     col, *button_cols = st.columns([7, 1, 1, 1])
     col.markdown("<p style='text-align: right; line-height: 40px;'>Download the figure:</p>", unsafe_allow_html=True)
-    
+
+    formats = ["pdf", "png", "svg"]
     for col, format in zip(button_cols, formats):
-        col.download_button(
+        cache_key = (selected_release(), gene_id_selected, plot_name, *export_key, format)
+
+        # Rendering takes a couple of seconds, so it happens in the rerun triggered by clicking the format,
+        # which then swaps the button for the actual download in the same slot of the column
+        slot = col.empty()
+        if cache_key not in export_cache:
+            if not slot.button(format.upper(), key = f'{plot_number}_{format}_render', help = f"Prepare the figure as {format.upper()}"):
+                continue
+
+        try:
+            data = export_cache.get(cache_key, lambda: _render_figure(fig, format, height, width))
+        except render_pool.RenderError as error:
+            st.warning(f"Could not prepare the {format.upper()} download. {error}")
+            continue
+
+        slot.download_button(
             label     = format.upper(),
-            data      = buffers[format],
+            data      = data,
             file_name = f"pf-haploatlas-{figure_name}.{format}",
             mime      = f"image/{format}",
             type      = "primary",
@@ -0,0 +1,161 @@
+"""
+Checks the vectorised abacus and world map aggregations against the groupby-apply passes they replaced, on a small
+fixture of samples
+"""
+import collections, os, sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.precompute import compute_abacus_cube, slice_abacus_cube, compute_worldmap_index, slice_worldmap_index
+
+def _locations_agg(x, ns_changes):
+    """The world map's aggregation function before precompute.compute_worldmap_index"""
+    names = collections.OrderedDict()
+    names['n'] = np.count_nonzero(x['ns_changes_homozygous'])
+    if names['n'] == 0:
+        names[f'frequency'] = 0
+        names['haplo_count'] = 0
+    else:
+        names['haplo_count'] = np.count_nonzero(( x['ns_changes'] == ns_changes))
+        names[f'frequency'] = names['haplo_count'] / names['n']
+
+    return pd.Series(names)
+
+def _groupby_frequencies(df_join, ns_changes, year):
+    """The world map's per country frequencies as computed before precompute.compute_worldmap_index"""
+    df = df_join[df_join['Exclusion reason'] == 'Analysis_set'].copy()
+    # The world map relabelled countries and coloured them by their majority population, which the metadata now has
+    df = df.drop(columns = ['Country', 'Population'])
+    df = df.rename(columns = {'Country display name': 'Country', 'Country majority population': 'Population'})
+    df.loc[df['ns_changes'] == 'wildtype', 'ns_changes'] = ''
+    df = df.loc[df['QC pass']]
+    df.loc[df.ns_changes == "", "ns_changes"] = "3D7 REF"
+    df['ns_changes_homozygous'] = ( df['ns_changes'] == df['ns_changes'].str.upper() )
+    df = df[(df['Year'] >= year[0]) & (df['Year'] <= year[1])]
+    df['Year-interval'] = str(year)
+
+    columns = ['iso_alpha', 'Country', 'Year-interval', 'Population']
+    if len(df.dropna(subset = columns)) == 0:
+        # The world map stopped with a warning here
+        return pd.DataFrame(columns = ['Country', 'iso_alpha', 'Year-interval', 'Population', 'n', 'haplo_count', 'frequency'])
+
+    # _locations_agg orders its keys differently for groups without homozygous samples, which makes apply stack
+    # rather than combine them, so they are put back in one order
+    return (
+        df
+        .groupby(columns, observed = True)
+        .apply(lambda x: _locations_agg(x, ns_changes)[['n', 'haplo_count', 'frequency']])
+        .sort_index()
+        .reset_index()
+        .set_index(['Country'])
+        .reset_index())
+
+def _abacus_locations_agg(x, ns_changes):
+    """The abacus plot's aggregation function before precompute.compute_abacus_cube"""
+    names = collections.OrderedDict()
+    names['n'] = np.count_nonzero(x['ns_changes_homozygous'])
+    if names['n'] == 0:
+        names[f'{ns_changes} frequency'] = np.nan
+    else:
+        names[f'{ns_changes} frequency'] = np.count_nonzero(
+            ( x['ns_changes'] == ns_changes)
+        ) / names['n']
+
+    return pd.Series(names)
+
+def _groupby_abacus_frequencies(df_join, ns_changes, min_samples):
+    """The abacus plot's per location and year frequencies as computed before precompute.compute_abacus_cube"""
+    df_samples_with_ns_changes = df_join[df_join['Exclusion reason'] == 'Analysis_set'].copy()
+
+    df_samples_with_ns_changes.loc[df_samples_with_ns_changes['Country'] == 'Democratic Republic of the Congo', ['Country']] = 'DRC'
+    df_samples_with_ns_changes.loc[df_samples_with_ns_changes.ns_changes == "", "ns_changes"] = "3D7 REF"
+
+    df_samples_with_ns_changes.loc[:,'ns_changes_homozygous'] = ( df_samples_with_ns_changes['ns_changes'] == df_samples_with_ns_changes['ns_changes'].str.upper() )
+
+    aggregated_locations = df_samples_with_ns_changes.groupby(['Population', 'Country', 'Admin level 1']).apply(lambda x: len(x) >= min_samples)
+    locations = aggregated_locations.index[aggregated_locations.values].values
+
+    df_frequencies = (
+        df_samples_with_ns_changes
+        .groupby(['Population', 'Year', 'Country', 'Admin level 1'])
+        .apply(lambda x: _abacus_locations_agg(x, ns_changes))
+        .reset_index()
+        .set_index(['Population', 'Country', 'Admin level 1'])
+        .loc[locations]
+        .reset_index()
+    )
+    return df_frequencies.loc[df_frequencies['n'] >= min_samples]
+
+@pytest.fixture
+def df_join():
+    rng = np.random.default_rng(0)
+    # iso_alpha, Country as in the metadata, Country display name, Country majority population, admin level 1 regions
+    countries = [
+        ('KHM', 'Cambodia', 'Cambodia', 'AS-SE-E', ['Pursat', 'Ratanakiri']),
+        ('GHA', 'Ghana', 'Ghana', 'AF-W', ['Ashanti', 'Upper East']),
+        ('COD', 'Democratic Republic of the Congo', 'DRC', 'AF-C', ['Kinshasa']),
+        (np.nan, 'Atlantis', 'Atlantis', 'AF-W', ['Poseidonia']), # no iso_alpha, dropped by the world map groupby
+    ]
+    haplotypes = ['', 'wildtype', 'C580Y', 'c580y', 'R539T', 'C580Y/R539T', 'c580Y']
+    size = 2000
+
+    country = rng.integers(len(countries), size = size)
+    df_join = pd.DataFrame({
+        'Exclusion reason':             rng.choice(['Analysis_set', 'Analysis_set', 'Analysis_set', 'Low_coverage'], size = size),
+        'QC pass':                      rng.random(size) < 0.9,
+        'Population':                   np.where(rng.random(size) < 0.1, 'AF-E', [countries[c][3] for c in country]),
+        'Country':                      [countries[c][1] for c in country],
+        'Admin level 1':                np.where(rng.random(size) < 0.05, None, [rng.choice(countries[c][4]) for c in country]),
+        'iso_alpha':                    [countries[c][0] for c in country],
+        'Country display name':         [countries[c][2] for c in country],
+        'Country majority population':  [countries[c][3] for c in country],
+        'Year':                         np.where(rng.random(size) < 0.05, np.nan, rng.integers(2000, 2020, size = size)),
+        'ns_changes':                   rng.choice(haplotypes, size = size),
+    })
+
+    # Three samples in a location of their own, kept or dropped depending on min_samples
+    df_join.loc[:2, ['Exclusion reason', 'Population', 'Admin level 1', 'Year', 'ns_changes']] = ['Analysis_set', 'AS-SE-E', 'Siem Reap', 2010, 'C580Y']
+    iso_alpha, name, display_name, majority_population, _ = countries[0]
+    df_join.loc[:2, ['iso_alpha', 'Country', 'Country display name', 'Country majority population']] = [iso_alpha, name, display_name, majority_population]
+    return df_join
+
+@pytest.fixture
+def df_haplotypes():
+    return pd.DataFrame({'ns_changes': ['', 'C580Y', 'c580y', 'R539T', 'C580Y/R539T', 'c580Y']})
+
+@pytest.mark.parametrize("ns_changes", ['3D7 REF', 'C580Y', 'R539T', 'C580Y/R539T', 'Y493H'])
+@pytest.mark.parametrize("year", [(2000, 2019), (2005, 2010), (2012, 2012), (1990, 1995), (2015, 2030)])
+@pytest.mark.parametrize("min_samples", [1, 10])
+def test_worldmap_index_matches_groupby(df_join, df_haplotypes, ns_changes, year, min_samples):
+    columns = ['Country', 'iso_alpha', 'Year-interval', 'Population', 'n', 'haplo_count', 'frequency']
+
+    expected = _groupby_frequencies(df_join, ns_changes, year)
+    expected = expected.loc[expected['n'] >= min_samples, columns].reset_index(drop = True)
+
+    index = compute_worldmap_index(df_join, df_haplotypes)
+    actual = slice_worldmap_index(index, ns_changes, year)
+    actual = actual.loc[actual['n'] >= min_samples, columns].reset_index(drop = True)
+
+    pd.testing.assert_frame_equal(actual, expected, check_dtype = False)
+
+@pytest.mark.parametrize("ns_changes", ['3D7 REF', 'C580Y', 'R539T', 'C580Y/R539T', 'Y493H'])
+@pytest.mark.parametrize("min_samples", [1, 3, 4, 10])
+def test_abacus_cube_matches_groupby(df_join, df_haplotypes, ns_changes, min_samples):
+    expected = _groupby_abacus_frequencies(df_join, ns_changes, min_samples).reset_index(drop = True)
+
+    cube = compute_abacus_cube(df_join, df_haplotypes)
+    actual = slice_abacus_cube(cube, ns_changes, min_samples)
+
+    pd.testing.assert_frame_equal(actual, expected[actual.columns], check_dtype = False)
+
+def test_abacus_fixture_covers_edge_cases(df_join):
+    """The cases the abacus equivalence relies on are in the fixture"""
+    analysis_set = df_join.loc[df_join['Exclusion reason'] == 'Analysis_set']
+    assert analysis_set['Year'].isna().any()
+    assert analysis_set['Admin level 1'].isna().any()
+    assert ( analysis_set['ns_changes'] != analysis_set['ns_changes'].str.upper() ).any()
+    location_sizes = analysis_set.groupby(['Population', 'Country', 'Admin level 1']).size()
+    assert ( location_sizes < 10 ).any() and ( location_sizes >= 10 ).any()